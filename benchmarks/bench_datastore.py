@@ -0,0 +1,90 @@
+"""Per-row loops against bulk Datastore operations on sqlite.
+
+Run from repository root: PYTHONPATH=. python benchmarks/bench_datastore.py [count]
+"""
+import os
+import sys
+import time
+import tempfile
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+from flask_userflow import SQLAlchemyDatastore
+
+
+def create_datastore(app):
+    db = SQLAlchemy(app)
+
+    class User(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        email = db.Column(db.String(255), unique=True)
+        auth_id = db.Column(db.String(255), unique=True)
+        is_active = db.Column(db.Boolean())
+
+    db.create_all()
+    return SQLAlchemyDatastore(db, User)
+
+
+def measure(name, func):
+    started = time.time()
+    func()
+    print('{:<36} {:8.1f} ms'.format(name, (time.time() - started) * 1000))
+
+
+def main(count=2000):
+    path = tempfile.mkstemp(suffix='.db')[1]
+    app = Flask('flask_userflow')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    with app.app_context():
+        datastore = create_datastore(app)
+        model = datastore.user_model
+        emails = ['user{}@example.com'.format(i) for i in range(count)]
+
+        def create_loop():
+            for email in emails:
+                datastore.put(datastore.create_user(email=email, is_active=True))
+            datastore.commit()
+
+        def bulk_create():
+            datastore.bulk_create_users([{'email': email, 'is_active': True}
+                                         for email in emails])
+            datastore.commit()
+
+        def find_loop():
+            return [datastore.find_user(email=email) for email in emails]
+
+        def find_by():
+            return datastore.find_users_by('email', emails)
+
+        def update_loop():
+            for user in model.query:
+                user.is_active = False
+            datastore.commit()
+
+        def bulk_update():
+            datastore.bulk_update_users([{'id': id_, 'is_active': True}
+                                         for id_, in datastore.db.session.query(model.id)])
+            datastore.commit()
+
+        print('{} rows'.format(count))
+        for loop, bulk in ((create_loop, bulk_create), (update_loop, bulk_update)):
+            for func in loop, bulk:
+                if func in (create_loop, bulk_create):
+                    datastore.delete_all(model.query.all())
+                    datastore.commit()
+                elif not model.query.count():
+                    bulk_create()
+                datastore.db.session.expunge_all()
+                measure(func.__name__, func)
+            if loop is create_loop:
+                for func in find_loop, find_by:
+                    datastore.db.session.expunge_all()
+                    measure(func.__name__, func)
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,58 @@
+"""Message build time with and without DKIM signing.
+
+Run from repository root: PYTHONPATH=. python benchmarks/bench_emails.py [count]
+"""
+import os
+import sys
+import subprocess
+import timeit
+
+from flask import Flask
+
+from flask_userflow.settings import Config
+from flask_userflow.emails import Emails
+
+
+def generate_dkim_key():
+    for args in (['-traditional'], []):
+        try:
+            return subprocess.check_output(['openssl', 'genrsa'] + args + ['1024'],
+                                           stderr=open(os.devnull, 'w'))
+        except subprocess.CalledProcessError:
+            pass
+
+
+def create_emails(app, **config):
+    app.config.update(('USERFLOW_' + k, v) for k, v in config.items())
+    return Emails(Config(app.config), None, None)
+
+
+def main(count=200):
+    app = Flask('flask_userflow')
+    app.config['SECRET_KEY'] = 'secret'
+    app.config['EMAIL_DEFAULT_FROM'] = 'py@test'
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    key = generate_dkim_key()
+    context = {'confirm_url': 'http://example.com/confirm/token', 'token': 'token'}
+
+    plain = create_emails(app)
+    signed = create_emails(app, DKIM_KEY=key, DKIM_DOMAIN='example.com', DKIM_SELECTOR='_dkim')
+    # emulate key parsing on each message
+    per_message = create_emails(app, DKIM_KEY=key, DKIM_DOMAIN='example.com',
+                                DKIM_SELECTOR='_dkim')
+    per_message.dkim_signer = None
+
+    with app.test_request_context():
+        for name, emails in (('no dkim', plain), ('dkim, key parsed per message', per_message),
+                             ('dkim, key parsed once', signed)):
+            def build():
+                message = emails.create('register_start', context, 'en')
+                message.set_mail_to('to@example.com')
+                message.as_string()
+            build()
+            spent = timeit.timeit(build, number=count)
+            print('{:<32} {:8.3f} ms/message'.format(name, spent / count * 1000))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
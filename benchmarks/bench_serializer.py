@@ -0,0 +1,74 @@
+"""Token verification time with growing number of signing keys:
+key id prefix (KeyedSerializer) against trying each key in turn,
+and size and verification time of auth_id token formats.
+
+Run from repository root: PYTHONPATH=. python benchmarks/bench_serializer.py [count]
+"""
+import sys
+import timeit
+
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+from flask_userflow.serializers import KeyedSerializer, CompactTokenSerializer
+
+
+class FallbackSerializer(object):
+    """Naive rotation, newest key first"""
+
+    def __init__(self, keys, salt=None):
+        self.serializers = [URLSafeTimedSerializer(key, salt=salt) for key in reversed(keys)]
+
+    def dumps(self, obj):
+        return self.serializers[0].dumps(obj)
+
+    def loads(self, token):
+        for serializer in self.serializers:
+            try:
+                return serializer.loads(token)
+            except BadSignature:
+                pass
+        raise BadSignature('No key matched')
+
+
+def verify(serializer, token):
+    try:
+        serializer.loads(token)
+    except BadSignature:
+        pass
+
+
+def main(count=2000):
+    data = {'id': 1, 'auth_id': 'c4ca4238a0b923820dcc509a6f75849b'}
+    print('{:>5} {:>28} {:>16} {:>16}'.format('keys', 'serializer', 'oldest key, us',
+                                              'invalid, us'))
+    for keys_count in (1, 2, 5, 10, 50):
+        secrets = ['secret{}'.format(i) for i in range(keys_count)]
+        keyed = KeyedSerializer(list(enumerate(secrets)), salt='auth_token')
+        fallback = FallbackSerializer(secrets, salt='auth_token')
+
+        for serializer, oldest in (
+                (keyed, KeyedSerializer([(0, secrets[0])], salt='auth_token')),
+                (fallback, URLSafeTimedSerializer(secrets[0], salt='auth_token'))):
+            token = oldest.dumps(data)
+            invalid = token[:-2] + 'xx'
+            result = [timeit.timeit(lambda: verify(serializer, t), number=count) / count * 1e6
+                      for t in (token, invalid)]
+            print('{:>5} {:>28} {:>16.1f} {:>16.1f}'.format(
+                keys_count, type(serializer).__name__, *result))
+
+    print('')
+    print('{:>28} {:>8} {:>16} {:>16}'.format('auth_id token', 'length', 'verify, us',
+                                              'invalid, us'))
+    auth_id = data['auth_id']
+    for serializer in (URLSafeTimedSerializer('secret', salt='auth_token'),
+                       CompactTokenSerializer([(0, 'secret')], salt='auth_token')):
+        token = serializer.dumps(auth_id)
+        invalid = token[:-2] + 'AA'
+        result = [timeit.timeit(lambda: verify(serializer, t), number=count) / count * 1e6
+                  for t in (token, invalid)]
+        print('{:>28} {:>8} {:>16.1f} {:>16.1f}'.format(
+            type(serializer).__name__, len(token), *result))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -4,7 +4,7 @@ from flask import current_app
 _userflow = LocalProxy(lambda: current_app.extensions['userflow'])  # noqa
 
 from .core import UserflowExtension
-from .datastore import SQLAlchemyDatastore
+from .datastore import SQLAlchemyDatastore, MemoryDatastore
 from .models import UserMixin
 
 
@@ -31,5 +31,5 @@ class Userflow(object):
 
 
 __all__ = (
-    'Userflow', 'UserflowExtension', 'UserMixin', 'SQLAlchemyDatastore',
+    'Userflow', 'UserflowExtension', 'UserMixin', 'SQLAlchemyDatastore', 'MemoryDatastore',
 )
@@ -0,0 +1,97 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class CacheStatsMixin(object):
+    hits = 0
+    misses = 0
+
+    def _count(self, value):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': total and float(self.hits) / total,
+        }
+
+
+class LRUCache(CacheStatsMixin):
+    """In-process LRU cache with optional TTL (seconds).
+
+    None values are not cached, get() returns None on miss.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key: (expires, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return self._count(None)
+            if expires and expires < time.time():
+                return self._count(None)
+            self._data[key] = (expires, value)
+            return self._count(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (ttl and time.time() + ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        stats = super(LRUCache, self).stats()
+        stats.update({'size': len(self._data), 'maxsize': self.maxsize})
+        return stats
+
+
+class BackendCache(CacheStatsMixin):
+    """Adapter for shared cache backends with get/set(timeout)/delete methods,
+    like werkzeug or flask-caching caches"""
+
+    def __init__(self, backend, ttl=None, prefix='userflow:'):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self._count(self.backend.get(u'{}{}'.format(self.prefix, key)))
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(u'{}{}'.format(self.prefix, key), value, timeout=ttl or self.ttl)
+
+    def delete(self, key):
+        self.backend.delete(u'{}{}'.format(self.prefix, key))
+
+
+def create_cache(backend, maxsize, ttl=None, prefix='userflow:'):
+    """Returns LRUCache or BackendCache if shared backend is passed"""
+    if backend is not None:
+        return BackendCache(backend, ttl, prefix)
+    return LRUCache(maxsize, ttl)
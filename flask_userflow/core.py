@@ -1,43 +1,106 @@
-from datetime import datetime
+import json
+import time
+import calendar
+from datetime import datetime, timedelta
 
 import bcrypt
 import pytz
-from itsdangerous import URLSafeTimedSerializer
-from werkzeug.security import safe_str_cmp
-from flask import Blueprint
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from flask import Blueprint, current_app, g, request, session, has_app_context
 from flask_login import LoginManager, current_user, AnonymousUserMixin
 from flask_principal import Principal, Identity, UserNeed, RoleNeed, identity_loaded
 from authomatic import Authomatic
 
+try:
+    from babel.dates import get_timezone_location
+except ImportError:
+    get_timezone_location = None
+
+from . import signals
 from .settings import Config
 from .request_utils import RequestUtils
 from .emails import Emails
-from .schemas import schemas_map
-from .models import AnonymousUser
+from .executor import Executor, ExecutorBusy
+from .hashers import PasswordHashers, call_hasher
+from .throttle import Throttle
+from .revocation import RevocationSet
+from .serializers import KeyedSerializer, CompactTokenSerializer
+from .cache import create_cache
+from .writebuffer import WriteBuffer
+from .datastore import QueryBudgetExceeded, get_query_stats
+from .schemas import schemas_map, CompiledSchema
+from .models import AnonymousUser, TokenUser
+from .utils import md5, next_dst_transition
 from .views import views_map, add_api_routes as _add_api_routes
 
 
 class UserflowExtension(object):
     anonymous_user_cls = AnonymousUser
+    token_user_cls = TokenUser
 
     config_cls = Config
     request_utils_cls = RequestUtils
     emails_cls = Emails
+    executor_cls = Executor
+    password_hashers_cls = PasswordHashers
+    throttle_cls = Throttle
+    revocation_set_cls = RevocationSet
+    write_buffer_cls = WriteBuffer
+    compiled_schema_cls = CompiledSchema
     schemas = schemas_map
     views = views_map
 
     def __init__(self, app, datastore, geoip=None, celery=None, message_cls=None,
-                 authomatic=None, views=None, schemas=None, add_api_routes=True):
+                 authomatic=None, views=None, schemas=None, add_api_routes=True,
+                 throttle_store=None, user_cache=None, roles_cache=None,
+                 outbox_store=None, revocation_store=None, status_cache=None):
         self.app = app
         self.datastore = datastore
 
         self.config = config = self.config_cls(app.config)
+        if config['PASSWORD_CALIBRATE']:
+            config['PASSWORD_ROUNDS'] = self.calibrate_password_rounds()
+        self.password_hashers = self.password_hashers_cls(config)
         self.request_utils = self.request_utils_cls(config, geoip)
-        self.emails = self.emails_cls(config, message_cls, celery)
+        self.throttle = self.throttle_cls(config, throttle_store)
+        self.user_cache = None
+        if config['USER_CACHE'] or user_cache is not None:
+            self.user_cache = create_cache(user_cache, config['USER_CACHE_SIZE'],
+                                           config['USER_CACHE_TTL'], 'userflow:user:')
+        self.status_cache = None
+        if config['STATUS_CACHE'] or status_cache is not None:
+            self.status_cache = create_cache(status_cache, config['STATUS_CACHE_SIZE'],
+                                             config['STATUS_CACHE_TTL'], 'userflow:status:')
+        if self.user_cache is not None or self.status_cache is not None:
+            signals.user_changed.connect(self._on_user_changed, sender=datastore)
+        self.roles_cache = None
+        if config['ROLES_CACHE'] or roles_cache is not None:
+            self.roles_cache = create_cache(roles_cache, config['ROLES_CACHE_SIZE'],
+                                            config['ROLES_CACHE_TTL'], 'userflow:roles:')
+        self.revocations = None
+        if config['AUTH_TOKEN_REVOCATION']:
+            if not config['AUTH_TOKEN_AGE']:
+                raise ValueError('AUTH_TOKEN_REVOCATION requires AUTH_TOKEN_AGE')
+            self.revocations = self.revocation_set_cls(config, revocation_store)
+        self.emails = self.emails_cls(config, message_cls, celery, outbox_store)
+        self.password_executor = self._create_password_executor()
+        self.rehash_executor = None
+        if config['PASSWORD_REHASH']:
+            self.rehash_executor = self.executor_cls('thread', config['PASSWORD_REHASH_WORKERS'],
+                                                     config['PASSWORD_REHASH_QUEUE_SIZE'])
+        self.track_login_buffer = None
+        if config['TRACK_LOGIN_BUFFER'] and datastore.track_login_model:
+            self.track_login_buffer = self.write_buffer_cls(
+                datastore, datastore.track_login_model,
+                config['TRACK_LOGIN_BUFFER_SIZE'], config['TRACK_LOGIN_BUFFER_INTERVAL'])
         self.authomatic = authomatic or Authomatic(config['AUTHOMATIC_CONFIG'],
                                                    config['AUTHOMATIC_SECRET_KEY'])
 
         self.schemas = schemas or self.schemas
+        if config['COMPILED_SCHEMAS']:
+            self.schemas = dict(self.schemas)
+            for name in config['COMPILED_SCHEMAS']:
+                self.schemas[name] = self.compiled_schema_cls(self.schemas[name])
         self.views = views or self.views
 
         self.blueprint = Blueprint('userflow', 'flask_userflow',
@@ -46,11 +109,17 @@ class UserflowExtension(object):
                                    template_folder='templates')
         if add_api_routes:
             _add_api_routes(config, self.views, self.blueprint)
+        self.blueprint.errorhandler(ExecutorBusy)(
+            lambda error: self.views['_executor_busy_processor'](error))
+        if config['QUERY_BUDGET'] is not None:
+            self.blueprint.after_request(self._check_query_budget)
         app.register_blueprint(self.blueprint)
 
         self._init_login_manager()
         self._init_principal()
 
+        self._timezone_choices = {}
+
         self.auth_token_serializer = self._create_serializer('auth_token')
         self.register_confirm_serializer = self._create_serializer('register_confirm')
         self.restore_confirm_serializer = \
@@ -59,14 +128,136 @@ class UserflowExtension(object):
     def _init_login_manager(self):
         self.login_manager = LoginManager(self.app)
         self.login_manager.user_loader(self._user_loader)
+        self.login_manager.request_loader(self._request_loader)
+        if self.config['AUTH_TOKEN_FORMAT'] == 'stateless':
+            self.app.after_request(self._set_auth_token_header)
         self.login_manager.anonymous_user = self.anonymous_user_cls
 
     def _user_loader(self, auth_id):
-        return self.datastore.find_user(auth_id=auth_id)
+        if self.revocations is not None and session.get('auth_token_id') in self.revocations:
+            return None
+        return self.get_user(auth_id=auth_id)
+
+    def get_auth_token(self, user):
+        if self.config['AUTH_TOKEN_FORMAT'] != 'stateless':
+            return self.auth_token_serializer.dumps(user.auth_id)
+        data = {field: getattr(user, field) for field in self.config['AUTH_TOKEN_FIELDS']}
+        data.update(id=user.id, auth_id=user.auth_id)
+        try:
+            data['roles'] = list(user.roles)
+        except NotImplementedError:
+            # no role_model and roles are not implemented by user model
+            pass
+        return self.auth_token_serializer.dumps(data)
+
+    def _request_loader(self, request):
+        token = request.headers.get(self.config['AUTH_TOKEN_HEADER'])
+        if not token:
+            return None
+        try:
+            data, issued = self.auth_token_serializer.loads(
+                token, max_age=self.config['AUTH_TOKEN_AGE'], return_timestamp=True)
+        except BadSignature:
+            return None
+        if self.revocations is not None and self.get_auth_token_id(token) in self.revocations:
+            return None
+        if not isinstance(data, dict):
+            return self.get_user(auth_id=data)
+
+        staleness = (datetime.utcnow() - issued).total_seconds()
+        if staleness <= self.config['AUTH_TOKEN_MAX_STALENESS']:
+            if request.method in self.config['AUTH_TOKEN_STATELESS_METHODS']:
+                return self.token_user_cls(data)
+            return self.get_user(auth_id=data['auth_id'])
+
+        # revoked by generate_auth_id if user is not found
+        user = self.get_user(auth_id=data['auth_id'])
+        if user is not None:
+            g._userflow_auth_token = self.get_auth_token(user)
+        return user
+
+    @staticmethod
+    def get_auth_token_id(token):
+        return md5(token)
+
+    def revoke_auth_token(self, token):
+        """Revokes token (and session it was issued for) until it expires,
+        returns False for invalid or expired token"""
+        if self.revocations is None:
+            raise RuntimeError('AUTH_TOKEN_REVOCATION is not enabled')
+        try:
+            _, issued = self.auth_token_serializer.loads(
+                token, max_age=self.config['AUTH_TOKEN_AGE'], return_timestamp=True)
+        except BadSignature:
+            return False
+        expires = calendar.timegm(issued.utctimetuple()) + self.config['AUTH_TOKEN_AGE']
+        self.revocations.add(self.get_auth_token_id(token), expires)
+        return True
+
+    def _set_auth_token_header(self, response):
+        token = getattr(g, '_userflow_auth_token', None)
+        if token:
+            response.headers[self.config['AUTH_TOKEN_HEADER']] = token
+        return response
+
+    def get_user(self, **kwargs):
+        """Returns user found by one of USER_IDENTITY_FIELDS, users are loaded
+        once per request and shared by schemas, views and user loader"""
+        if len(kwargs) != 1 or not has_app_context():
+            return self.datastore.find_user(**kwargs)
+        (field, value), = kwargs.items()
+        if field not in self.config['USER_IDENTITY_FIELDS']:
+            return self.datastore.find_user(**kwargs)
+
+        identity_map = getattr(g, '_userflow_users', None)
+        if identity_map is None:
+            identity_map = g._userflow_users = {}
+        user = identity_map.get((field, value))
+        if user is None:
+            user = self._find_user(field, value)
+            # not found users are not remembered, they may be created in request
+            if user is not None:
+                for field in self.config['USER_IDENTITY_FIELDS']:
+                    if getattr(user, field, None) is not None:
+                        identity_map[(field, getattr(user, field))] = user
+        return user
+
+    def _find_user(self, field, value):
+        if field != 'auth_id' or self.user_cache is None:
+            return self.datastore.find_user(**{field: value})
+
+        data = self.user_cache.get(value)
+        if data is not None:
+            return self.datastore.load_model(self.datastore.user_model, data)
+        user = self.datastore.find_user(auth_id=value)
+        if user:
+            self.user_cache.set(value, self.datastore.dump_model(
+                user, exclude=self.config['USER_CACHE_EXCLUDE']))
+        return user
+
+    def _on_user_changed(self, datastore, user, auth_ids):
+        self.invalidate_user(*auth_ids)
+
+    def invalidate_user(self, *auth_ids):
+        identity_map = getattr(g, '_userflow_users', {}) if has_app_context() else {}
+        for auth_id in auth_ids:
+            if auth_id:
+                identity_map.pop(('auth_id', auth_id), None)
+                if self.user_cache is not None:
+                    self.user_cache.delete(auth_id)
+        self.invalidate_status(*auth_ids)
+
+    def invalidate_status(self, *auth_ids):
+        request_cache = getattr(g, '_userflow_status', {}) if has_app_context() else {}
+        for auth_id in auth_ids:
+            if auth_id:
+                request_cache.pop(auth_id, None)
+                if self.status_cache is not None:
+                    self.status_cache.delete(auth_id)
 
     def _init_principal(self):
         self.principal = Principal(self.app, use_sessions=False)
-        self.principal.identity_loader = self._identity_loader
+        self.principal.identity_loader(self._identity_loader)
         identity_loaded.connect_via(self.app)(self._on_identity_loaded)
 
     @staticmethod
@@ -75,46 +266,197 @@ class UserflowExtension(object):
             identity = Identity(current_user.id)
             return identity
 
-    @staticmethod
-    def _on_identity_loaded(sender, identity):
+    def _on_identity_loaded(self, sender, identity):
         if hasattr(current_user, 'id'):
             identity.provides.add(UserNeed(current_user.id))
 
-        for role in current_user.roles:
-            identity.provides.add(RoleNeed(role.name))
+        try:
+            roles = current_user.roles
+        except NotImplementedError:
+            # no role_model and roles are not implemented by user model
+            roles = ()
+        for role in roles:
+            identity.provides.add(RoleNeed(role))
 
         identity.user = current_user
 
+    def get_roles(self, user):
+        return self.load_roles([user])[user.id]
+
+    def load_roles(self, users):
+        """Returns {user_id: [role names]}, roles are loaded once per request
+        (and by one query for all users not found in cache)"""
+        if not self.datastore.role_model:
+            raise NotImplementedError('Implement this or add role_model to datastore')
+
+        request_cache = getattr(g, '_userflow_roles', None)
+        if request_cache is None:
+            request_cache = g._userflow_roles = {}
+
+        result, missing = {}, []
+        for user in users:
+            roles = request_cache.get(user.id)
+            if roles is None and self.roles_cache is not None:
+                roles = self.roles_cache.get(user.id)
+            if roles is None:
+                missing.append(user.id)
+            else:
+                result[user.id] = request_cache[user.id] = roles
+
+        if missing:
+            for user_id, roles in self.datastore.find_roles_for_users(missing).items():
+                roles = [role.name for role in roles]
+                result[user_id] = request_cache[user_id] = roles
+                if self.roles_cache is not None:
+                    self.roles_cache.set(user_id, roles)
+        return result
+
+    def invalidate_roles(self, user_id):
+        getattr(g, '_userflow_roles', {}).pop(user_id, None)
+        if self.roles_cache is not None:
+            self.roles_cache.delete(user_id)
+
+    def query_stats(self):
+        """Returns datastore calls stats for current request"""
+        return get_query_stats()
+
+    def _check_query_budget(self, response):
+        stats = get_query_stats()
+        if stats['calls'] > self.config['QUERY_BUDGET']:
+            message = 'Datastore query budget exceeded in {}: {} > {} ({})'.format(
+                request.endpoint, stats['calls'], self.config['QUERY_BUDGET'],
+                ', '.join('{}: {}'.format(name, count)
+                          for name, (count, _) in sorted(stats['methods'].items())))
+            if self.config['QUERY_BUDGET_RAISE']:
+                raise QueryBudgetExceeded(message)
+            current_app.logger.warning(message)
+        return response
+
     def _create_serializer(self, name):
         salt = self.config.get('%s_SALT' % name.upper())
-        return URLSafeTimedSerializer(secret_key=self.config['SECRET_KEY'], salt=salt)
+        if self.config['SECRET_KEYS']:
+            serializer = KeyedSerializer(self.config['SECRET_KEYS'], salt=salt)
+        else:
+            serializer = URLSafeTimedSerializer(secret_key=self.config['SECRET_KEY'], salt=salt)
+        if name == 'auth_token' and self.config['AUTH_TOKEN_FORMAT'] == 'compact':
+            keys = self.config['SECRET_KEYS'] or [(0, self.config['SECRET_KEY'])]
+            return CompactTokenSerializer(keys, salt=salt, fallback=serializer)
+        return serializer
+
+    def _create_password_executor(self):
+        if self.config['PASSWORD_EXECUTOR']:
+            return self.executor_cls(self.config['PASSWORD_EXECUTOR'],
+                                     self.config['PASSWORD_EXECUTOR_WORKERS'],
+                                     self.config['PASSWORD_EXECUTOR_QUEUE_SIZE'])
+
+    def _call_hasher(self, hasher, method, *args):
+        if self.password_executor:
+            return self.password_executor.run(call_hasher, hasher, method, *args)
+        return call_hasher(hasher, method, *args)
 
     def encrypt_password(self, password):
-        if isinstance(password, unicode):
-            password = password.encode('utf8')
-        salt = bcrypt.gensalt(rounds=self.config['PASSWORD_ROUNDS'],
-                              prefix=self.config['PASSWORD_IDENT'])
-        return bcrypt.hashpw(password, salt).decode('utf8')
+        return self._call_hasher(self.password_hashers.default, 'encrypt', password)
 
     def verify_password(self, password, password_hash):
-        if isinstance(password, unicode):
-            password = password.encode('utf8')
-        if isinstance(password_hash, unicode):
-            password_hash = password_hash.encode('utf8')
-        return safe_str_cmp(bcrypt.hashpw(password, password_hash), password_hash)
+        hasher = self.password_hashers.identify(password_hash)
+        if not hasher:
+            return False
+        return self._call_hasher(hasher, 'verify', password, password_hash)
+
+    def calibrate_password_rounds(self):
+        """Returns max bcrypt rounds fitting PASSWORD_CALIBRATE_TIME on this host"""
+        rounds = self.config['PASSWORD_CALIBRATE_MIN_ROUNDS']
+        max_rounds = self.config['PASSWORD_CALIBRATE_MAX_ROUNDS']
+        budget = self.config['PASSWORD_CALIBRATE_TIME']
+
+        salt = bcrypt.gensalt(rounds=rounds, prefix=self.config['PASSWORD_IDENT'])
+        started = time.time()
+        bcrypt.hashpw(b'calibrate', salt)
+        spent = time.time() - started
+
+        # each round doubles hashing time
+        while rounds < max_rounds and spent * 2 <= budget:
+            rounds += 1
+            spent *= 2
+        return rounds
+
+    def password_needs_rehash(self, password_hash):
+        return self.password_hashers.needs_rehash(password_hash)
+
+    def rehash_password(self, user, password):
+        """Updates user password hash in background pool, returns AsyncResult
+        or None if pool is full"""
+        try:
+            return self.rehash_executor.submit(self._rehash_password,
+                                               current_app._get_current_object(),
+                                               user.auth_id, user.password, password)
+        except ExecutorBusy:
+            return None
+
+    def _rehash_password(self, app, auth_id, password_hash, password):
+        with app.app_context():
+            try:
+                user = self.datastore.find_user(auth_id=auth_id)
+                # skip if password was changed meanwhile
+                if user and user.password == password_hash:
+                    user.password = self.encrypt_password(password)
+                    self.datastore.commit()
+            except Exception:
+                app.logger.exception('Password rehash failed')
+
+    def flush(self):
+        """Writes buffered login tracking rows, returns written rows count"""
+        if self.track_login_buffer is not None:
+            return self.track_login_buffer.flush()
+        return 0
+
+    def stats(self):
+        """Returns stats of executor, throttle, caches and queues, None for disabled"""
+        objects = {
+            'password_executor': self.password_executor,
+            'rehash_executor': self.rehash_executor,
+            'throttle': self.throttle,
+            'user_cache': self.user_cache,
+            'roles_cache': self.roles_cache,
+            'status_cache': self.status_cache,
+            'ua_cache': self.request_utils.ua_cache,
+            'geoip_cache': self.request_utils.geoip_cache,
+            'email_queue': self.emails.queue,
+            'email_outbox': self.emails.outbox,
+            'revocations': self.revocations,
+            'track_login_buffer': self.track_login_buffer,
+        }
+        return {name: obj.stats() if obj is not None else None
+                for name, obj in objects.items()}
 
     def get_timezone_choices(self, locale=None):
-        # l18n may be used for timezone names localization,
-        # but it has some issues to workaround
+        return self.timezone_choices(locale)['choices']
+
+    def timezone_choices(self, locale=None):
+        """Returns dict with choices, etag and expires (next DST transition),
+        cached per locale until expiration"""
+        cached = self._timezone_choices.get(locale)
+        if cached and cached['expires'] > datetime.utcnow():
+            return cached
+
+        now = datetime.utcnow()
+        # babel is used for timezone names localization if installed
+        localize = locale and get_timezone_location
         result = []
         for tz in pytz.common_timezones:
-            now = datetime.now(pytz.timezone(tz))
-            ofs = now.strftime("%z")
-            result.append((int(ofs), tz, "(GMT%s) %s" % (ofs, tz)))
+            ofs = pytz.utc.localize(now).astimezone(pytz.timezone(tz)).strftime("%z")
+            name = localize and get_timezone_location(tz, locale=locale) or tz
+            result.append((int(ofs), tz, "(GMT%s) %s" % (ofs, name)))
 
         result.sort()
 
         for i in xrange(len(result)):
             result[i] = result[i][1:]
 
-        return result
+        expires = next_dst_transition(pytz.common_timezones, now)
+        self._timezone_choices[locale] = cached = {
+            'choices': result,
+            'etag': md5(json.dumps(result)),
+            'expires': expires or now + timedelta(days=365),
+        }
+        return cached
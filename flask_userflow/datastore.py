@@ -1,7 +1,29 @@
+import time
+import threading
 from functools import partial
 
+from flask import g, has_app_context
+
+from . import signals
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def get_query_stats():
+    """Returns datastore calls count, time and {method: [count, time]}
+    for current app context (request). Time of SQLAlchemyDatastore
+    find_{model}s excludes execution of returned lazy query"""
+    stats = getattr(g, '_userflow_query_stats', None)
+    if stats is None:
+        stats = g._userflow_query_stats = {'calls': 0, 'time': 0., 'methods': {}}
+    return stats
+
 
 class Datastore(object):
+    instrumented_prefixes = ('find_', 'put', 'delete', 'commit', 'rollback', 'bulk_')
+
     def __init__(self, db, user_model, role_model=None, provider_user_model=None,
                  track_login_model=None):
         self.db = db
@@ -10,24 +32,107 @@ class Datastore(object):
         self.provider_user_model = provider_user_model
         self.track_login_model = track_login_model
         self._bind_methods()
+        self._instrument()
+
+    def _instrument(self):
+        self._local = threading.local()
+        for name in dir(self):
+            if name.startswith(self.instrumented_prefixes):
+                method = getattr(self, name)
+                if callable(method):
+                    setattr(self, name, self._instrumented(name, method))
+
+    def _instrumented(self, name, method):
+        def wrapper(*args, **kwargs):
+            # nested calls (find_roles_for_users -> find_roles_by) are counted once
+            if getattr(self._local, 'active', False):
+                return method(*args, **kwargs)
+            self._local.active = True
+            started = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._local.active = False
+                spent = time.time() - started
+                if has_app_context():
+                    stats = get_query_stats()
+                    stats['calls'] += 1
+                    stats['time'] += spent
+                    method_stats = stats['methods'].setdefault(name, [0, 0.])
+                    method_stats[0] += 1
+                    method_stats[1] += spent
+                signals.datastore_called.send(self, method=name, duration=spent)
+        return wrapper
 
     def commit(self):
         raise NotImplementedError()
 
+    def rollback(self):
+        raise NotImplementedError()
+
     def put(self, obj):
         raise NotImplementedError()
 
     def delete(self, obj):
         raise NotImplementedError()
 
+    def put_all(self, objs):
+        for obj in objs:
+            self.put(obj)
+
+    def delete_all(self, objs):
+        for obj in objs:
+            self.delete(obj)
+
+    def bulk_insert(self, model, rows):
+        """Inserts rows (list of dicts) and commits. Override this to insert
+        them in one statement, without touching current session"""
+        for row in rows:
+            self.put(self._create_model(model, **row))
+        self.commit()
+
+    def dump_model(self, obj, exclude=()):
+        """Returns picklable object state for caching"""
+        return {k: v for k, v in vars(obj).items() if k not in exclude}
+
+    def load_model(self, model, data):
+        """Restores object from dump_model state without querying,
+        excluded fields should be loaded on access"""
+        obj = model.__new__(model)
+        obj.__dict__.update(data)
+        return obj
+
     def _find_models(self, model, **kwargs):
         raise NotImplementedError()
 
+    def _find_models_by(self, model, field, values):
+        """Returns list of models with field value in values"""
+        return [obj for value in set(values)
+                for obj in self._find_models(model, **{field: value})]
+
+    def _bulk_create_models(self, model, rows):
+        """Creates models from rows (list of dicts) in current transaction"""
+        self.put_all([self._create_model(model, **row) for row in rows])
+
+    def _bulk_update_models(self, model, rows):
+        """Updates models from rows (list of dicts with id) in current transaction"""
+        for row in rows:
+            obj = self._find_model(model, id=row['id'])
+            for key, value in row.items():
+                setattr(obj, key, value)
+            self.put(obj)
+
+    def find_roles_for_users(self, user_ids):
+        """Returns {user_id: [roles]} for all user_ids"""
+        result = {user_id: [] for user_id in user_ids}
+        for role in self.find_roles_by('user_id', user_ids):
+            result[role.user_id].append(role)
+        return result
+
     def _find_model(self, model, **kwargs):
-        try:
-            return self._find_models(**kwargs)[0]
-        except IndexError:
-            return None
+        for obj in self._find_models(model, **kwargs):
+            return obj
+        return None
 
     def _create_model(self, model, **kwargs):
         obj = model(**kwargs)
@@ -40,26 +145,293 @@ class Datastore(object):
                 find_models = 'find_{}s'.format(model_name)
                 find_model = 'find_{}'.format(model_name)
                 create_model = 'create_{}'.format(model_name)
+                find_models_by = 'find_{}s_by'.format(model_name)
+                bulk_create_models = 'bulk_create_{}s'.format(model_name)
+                bulk_update_models = 'bulk_update_{}s'.format(model_name)
                 if not hasattr(self, find_models):
                     setattr(self, find_models, partial(self._find_models, model))
                 if not hasattr(self, find_model):
                     setattr(self, find_model, partial(self._find_model, model))
                 if not hasattr(self, create_model):
                     setattr(self, create_model, partial(self._create_model, model))
+                if not hasattr(self, find_models_by):
+                    setattr(self, find_models_by, partial(self._find_models_by, model))
+                if not hasattr(self, bulk_create_models):
+                    setattr(self, bulk_create_models,
+                            partial(self._bulk_create_models, model))
+                if not hasattr(self, bulk_update_models):
+                    setattr(self, bulk_update_models,
+                            partial(self._bulk_update_models, model))
 
 
 class SQLAlchemyDatastore(Datastore):
+    chunk_size = 500
+
+    def __init__(self, *args, **kwargs):
+        super(SQLAlchemyDatastore, self).__init__(*args, **kwargs)
+        from sqlalchemy import event
+        event.listen(self.user_model, 'after_update', self._on_user_changed)
+        event.listen(self.user_model, 'after_delete', self._on_user_changed)
+
+    def _on_user_changed(self, mapper, connection, user):
+        from sqlalchemy import inspect
+        history = inspect(user).attrs.auth_id.history
+        auth_ids = [user.auth_id] + list(history.deleted or ())
+        signals.user_changed.send(self, user=user, auth_ids=auth_ids)
+
+    def dump_model(self, obj, exclude=()):
+        from sqlalchemy import inspect
+        return {attr.key: getattr(obj, attr.key)
+                for attr in inspect(obj).mapper.column_attrs if attr.key not in exclude}
+
+    def load_model(self, model, data):
+        from sqlalchemy.orm import make_transient_to_detached
+        # attributes missing in data are unloaded, and are queried on access
+        obj = model(**data)
+        make_transient_to_detached(obj)
+        return self.db.session.merge(obj, load=False)
+
     def commit(self):
         self.db.session.commit()
 
+    def rollback(self):
+        self.db.session.rollback()
+
     def put(self, obj):
         self.db.session.add(obj)
 
     def delete(self, obj):
         self.db.session.delete(obj)
 
+    def put_all(self, objs):
+        self.db.session.add_all(objs)
+
+    def bulk_insert(self, model, rows):
+        from sqlalchemy import inspect
+        if not rows:
+            return
+        # attribute names to column names
+        columns = {attr.key: attr.columns[0].key
+                   for attr in inspect(model).column_attrs}
+        rows = [{columns[key]: value for key, value in row.items()} for row in rows]
+        with self.db.engine.begin() as connection:
+            connection.execute(model.__table__.insert(), rows)
+
     def _find_model(self, model, **kwargs):
         return model.query.filter_by(**kwargs).first()
 
+    def _find_models_by(self, model, field, values):
+        values = list(set(values))
+        column = getattr(model, field)
+        result = []
+        for i in range(0, len(values), self.chunk_size):
+            result.extend(model.query.filter(column.in_(values[i:i + self.chunk_size])))
+        return result
+
+    def _bulk_create_models(self, model, rows):
+        # objects are not returned, primary keys are not fetched
+        self.db.session.bulk_insert_mappings(model, rows)
+
+    def _bulk_update_models(self, model, rows):
+        from sqlalchemy import inspect
+        if model is self.user_model:
+            # orm update events are not emitted, invalidate by previous auth_ids
+            pk = inspect(model).primary_key[0]
+            ids = [row[pk.key] for row in rows]
+            auth_ids = []
+            for i in range(0, len(ids), self.chunk_size):
+                query = self.db.session.query(model.auth_id) \
+                    .filter(pk.in_(ids[i:i + self.chunk_size]))
+                auth_ids.extend(auth_id for auth_id, in query)
+        self.db.session.bulk_update_mappings(model, rows)
+        if model is self.user_model:
+            auth_ids += [row['auth_id'] for row in rows if row.get('auth_id')]
+            signals.user_changed.send(self, user=None, auth_ids=auth_ids)
+
     def _find_models(self, model, **kwargs):
         return model.query.filter_by(**kwargs)
+
+
+class MemoryDatastore(Datastore):
+    """In-process datastore with hash indexes, for tests, benchmarks
+    and small single-process deployments.
+
+    Models are plain classes accepting fields as keyword arguments,
+    "id" is primary key and is assigned on flush. Public instance attributes
+    are stored as model fields. Objects are loaded into per app context
+    session (like sqlalchemy scoped session), changes of loaded objects
+    are flushed on commit and before queries, and reverted on rollback.
+    Flushed changes are visible to other sessions before commit.
+    """
+
+    indexes = {
+        'user': (('email',), ('auth_id',)),
+        'role': (('user_id',),),
+        'provider_user': (('provider', 'provider_user_id'), ('user_id',)),
+        'track_login': (),
+    }
+
+    def __init__(self, user_model, role_model=None, provider_user_model=None,
+                 track_login_model=None, indexes=None):
+        super(MemoryDatastore, self).__init__(None, user_model, role_model,
+                                              provider_user_model, track_login_model)
+        indexes = dict(self.indexes, **(indexes or {}))
+        self._rows = {}  # model: {id: fields}
+        self._indexes = {}  # model: {fields: {values: set of ids}}
+        self._last_ids = {}
+        for model_name, fields_list in indexes.items():
+            model = getattr(self, '{}_model'.format(model_name))
+            if model:
+                self._rows[model] = {}
+                self._indexes[model] = {fields: {} for fields in fields_list}
+                self._last_ids[model] = 0
+        self._lock = threading.RLock()
+
+    @property
+    def _session(self):
+        session = getattr(g, '_userflow_memory_session', None)
+        if session is None:
+            session = g._userflow_memory_session = {
+                'identity': {},  # (model, id): obj
+                'loaded': {},  # (model, id): fields when loaded or flushed
+                'new': [],
+                'deleted': [],
+                'undo': [],  # (model, id, previous fields or None)
+            }
+        return session
+
+    @staticmethod
+    def _fields(obj):
+        return {k: v for k, v in vars(obj).items() if not k.startswith('_')}
+
+    def _load(self, model, id, fields=None):
+        session = self._session
+        obj = session['identity'].get((model, id))
+        if obj is None:
+            if fields is None:
+                fields = dict(self._rows[model][id])
+            obj = model.__new__(model)
+            obj.__dict__.update(fields)
+            session['identity'][(model, id)] = obj
+            session['loaded'][(model, id)] = dict(fields)
+        return obj
+
+    def _write(self, model, id, fields):
+        """Replaces stored fields (None to remove) and updates indexes"""
+        previous = self._rows[model].get(id)
+        for index_fields, index in self._indexes[model].items():
+            if previous is not None:
+                index[tuple(previous.get(f) for f in index_fields)].discard(id)
+            if fields is not None:
+                index.setdefault(tuple(fields.get(f) for f in index_fields), set()).add(id)
+        if fields is None:
+            del self._rows[model][id]
+        else:
+            self._rows[model][id] = fields
+        return previous
+
+    def _flush(self):
+        session, changed = self._session, []
+        with self._lock:
+            for obj in session['new']:
+                model = type(obj)
+                if getattr(obj, 'id', None) is None:
+                    self._last_ids[model] += 1
+                    obj.id = self._last_ids[model]
+                session['identity'][(model, obj.id)] = obj
+            session['new'] = []
+
+            for obj in session['deleted']:
+                model = type(obj)
+                session['identity'].pop((model, obj.id), None)
+                session['loaded'].pop((model, obj.id), None)
+                if obj.id in self._rows[model]:
+                    session['undo'].append((model, obj.id, self._write(model, obj.id, None)))
+                    if model is self.user_model:
+                        changed.append((obj, [obj.auth_id]))
+            session['deleted'] = []
+
+            for (model, id), obj in session['identity'].items():
+                fields, loaded = self._fields(obj), session['loaded'].get((model, id), {})
+                if fields == loaded:
+                    continue
+                # write changed fields only, to not overwrite other sessions changes
+                previous = self._rows[model].get(id)
+                updates = {k: v for k, v in fields.items() if k not in loaded or loaded[k] != v}
+                self._write(model, id, dict(previous or {}, **updates))
+                session['loaded'][(model, id)] = dict(fields)
+                session['undo'].append((model, id, previous))
+                if model is self.user_model and previous is not None:
+                    changed.append((obj, [fields.get('auth_id'), previous.get('auth_id')]))
+
+        for user, auth_ids in changed:
+            signals.user_changed.send(self, user=user, auth_ids=auth_ids)
+
+    def commit(self):
+        self._flush()
+        self._session['undo'] = []
+
+    def rollback(self):
+        session = self._session
+        with self._lock:
+            for model, id, fields in reversed(session['undo']):
+                self._write(model, id, fields)
+            for (model, id), obj in list(session['identity'].items()):
+                fields = self._rows[model].get(id)
+                if fields is None:
+                    del session['identity'][(model, id)]
+                    continue
+                for key in self._fields(obj):
+                    delattr(obj, key)
+                obj.__dict__.update(fields)
+                session['loaded'][(model, id)] = dict(fields)
+        session.update(new=[], deleted=[], undo=[])
+
+    def put(self, obj):
+        self._session['new'].append(obj)
+
+    def delete(self, obj):
+        self._session['deleted'].append(obj)
+
+    def bulk_insert(self, model, rows):
+        # Datastore.bulk_insert commits current session
+        with self._lock:
+            for row in rows:
+                self._last_ids[model] += 1
+                self._write(model, self._last_ids[model],
+                            dict(row, id=self._last_ids[model]))
+
+    def dump_model(self, obj, exclude=()):
+        return {k: v for k, v in self._fields(obj).items() if k not in exclude}
+
+    def load_model(self, model, data):
+        # excluded fields are taken from stored row
+        fields = dict(self._rows[model].get(data['id'], {}))
+        fields.update(data)
+        return self._load(model, data['id'], fields)
+
+    def _find_ids(self, model, kwargs):
+        if 'id' in kwargs:
+            return [kwargs['id']] if kwargs['id'] in self._rows[model] else []
+        # use index with most fields matching query
+        best = None
+        for fields in self._indexes[model]:
+            if set(fields) <= set(kwargs) and len(fields) > len(best or ()):
+                best = fields
+        if best is None:
+            return sorted(self._rows[model])
+        return sorted(self._indexes[model][best].get(tuple(kwargs[f] for f in best), ()))
+
+    def _find_models(self, model, **kwargs):
+        self._flush()
+        result = []
+        with self._lock:
+            for id in self._find_ids(model, kwargs):
+                fields = self._rows[model][id]
+                if all(fields.get(k) == v for k, v in kwargs.items()):
+                    result.append((id, dict(fields)))
+        return [self._load(model, *row) for row in result]
+
+    def _find_models_by(self, model, field, values):
+        return [obj for value in sorted(set(values))
+                for obj in self._find_models(model, **{field: value})]
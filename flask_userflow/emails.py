@@ -1,10 +1,18 @@
-from flask import render_template
+from flask import current_app
+
+from .mailqueue import EmailQueue, EmailBatcher
+from .outbox import Outbox
 
 
 class Emails(object):
     message_cls = None
+    queue_cls = EmailQueue
+    batcher_cls = EmailBatcher
+    outbox_cls = Outbox
+    queue = None
+    outbox = None
 
-    def __init__(self, config, message_cls, celery):
+    def __init__(self, config, message_cls, celery, outbox_store=None):
         if message_cls:
             self.message_cls = message_cls
         if not self.message_cls:
@@ -19,35 +27,153 @@ class Emails(object):
                 raise RuntimeError('No flask_emails, and message_cls is not configured')
             self.send = send
 
+        elif celery and config['EMAIL_CELERY_BATCH']:
+            retries, backoff = config['EMAIL_QUEUE_RETRIES'], config['EMAIL_QUEUE_BACKOFF']
+
+            def send_batch(task, name, locale, recipients):
+                failed = self._send_batch(name, locale, recipients)
+                if failed and task.request.retries < retries:
+                    raise task.retry(args=(name, locale, failed),
+                                     countdown=backoff * 2 ** task.request.retries)
+                if failed:
+                    current_app.logger.error('Email sending failed: %s to %s', name,
+                                             ', '.join(to for to, _ in failed))
+                    for to, _ in failed:
+                        self.discard_outbox(name, to)
+            self.send_task = celery.task(bind=True, max_retries=retries)(send_batch)
+            self.queue = self.batcher_cls(self.send_task, config['EMAIL_CELERY_BATCH_SIZE'],
+                                          config['EMAIL_CELERY_BATCH_DELAY'])
+            self.send = self.queue.send
+
         elif celery:
-            def send(*args, **kwargs):
-                return self._send(*args, **kwargs)
+            def send(name, to, context, locale=None):
+                return self._send_or_discard(self._send, name, to, context, locale)
             self.send_task = celery.task(send)
 
             def send_delay(name, to, context, locale=None):
                 return self.send_task.delay(name, to, context, locale)
             self.send = send_delay
 
+        elif config['EMAIL_QUEUE']:
+            self.queue = self.queue_cls(self, config['EMAIL_QUEUE_WORKERS'],
+                                        config['EMAIL_QUEUE_BATCH_SIZE'],
+                                        config['EMAIL_QUEUE_RETRIES'],
+                                        config['EMAIL_QUEUE_BACKOFF'],
+                                        config['EMAIL_QUEUE_IDLE_TIMEOUT'])
+            self.send = self.queue.send
+
         else:
             self.send = self._send
 
+        if config['EMAIL_OUTBOX_WINDOW'] and self.message_cls:
+            self.outbox = self.outbox_cls(config, outbox_store)
+            dispatch = self.send
+
+            def send_outbox(name, to, context, locale=None):
+                if self.outbox.add(name, to):
+                    return self._send_or_discard(dispatch, name, to, context, locale)
+            self.send = send_outbox
+
         self.dkim_key = config.get('DKIM_KEY')
         if not self.dkim_key and config.get('DKIM_KEY_PATH'):
             self.dkim_key = open(config['DKIM_KEY_PATH']).read()
         self.dkim_domain = config.get('DKIM_DOMAIN')
         self.dkim_selector = config.get('DKIM_SELECTOR')
 
+        # parse private key once instead of on each message.dkim() call
+        self.dkim_signer = None
+        signer_cls = getattr(self.message_cls, 'signer_cls', None)
+        if self.dkim_key and signer_cls:
+            self.dkim_signer = signer_cls(key=self.dkim_key, domain=self.dkim_domain,
+                                          selector=self.dkim_selector)
+
+        self.default_locale = config['DEFAULT_LOCALE']
+        self._templates = {}
+
+    def discard_outbox(self, name, to):
+        """Called on delivery failure, so user may request email again"""
+        if self.outbox is not None:
+            self.outbox.discard(name, to)
+
+    def _send_or_discard(self, send, name, to, context, locale=None):
+        # failed sync send may return unsuccessful response if fail_silently
+        try:
+            result = send(name, to, context, locale)
+        except Exception:
+            self.discard_outbox(name, to)
+            raise
+        if not getattr(result, 'success', True):
+            self.discard_outbox(name, to)
+        return result
+
+    def get_templates(self, name, locale=None):
+        """Returns (subject, html) compiled templates, cached per (name, locale).
+        Looks for userflow/emails/{locale}/{name}.html, then for DEFAULT_LOCALE,
+        then for userflow/emails/{name}.html"""
+        templates = self._templates.get((name, locale))
+        if templates is None:
+            templates = tuple(
+                current_app.jinja_env.select_template(self._template_names(name, locale, s))
+                for s in ('_subject.txt', '.html'))
+            # compiled templates are not cached in templates auto reload mode
+            if not current_app.templates_auto_reload:
+                self._templates[(name, locale)] = templates
+        return templates
+
+    def _template_names(self, name, locale, suffix):
+        names = ['userflow/emails/{}/{}{}'.format(locale_, name, suffix)
+                 for locale_ in (locale, self.default_locale) if locale_]
+        names.append('userflow/emails/{}{}'.format(name, suffix))
+        return names
+
+    @staticmethod
+    def _render(template, context):
+        context = dict(context)
+        current_app.update_template_context(context)
+        return template.render(context)
+
     def create(self, name, context, locale):
-        subject_template = 'userflow/emails/{}_subject.txt'.format(name)
-        html_template = 'userflow/emails/{}.html'.format(name)
-        subject = render_template(subject_template, **context)
-        html = render_template(html_template, **context)
+        subject_template, html_template = self.get_templates(name, locale)
+        subject = self._render(subject_template, context)
+        html = self._render(html_template, context)
         message = self.message_cls(subject=subject, html=html)
-        if self.dkim_key:
+        if self.dkim_signer:
+            message._signer = self.dkim_signer
+        elif self.dkim_key:
             message.dkim(key=self.dkim_key, domain=self.dkim_domain,
                          selector=self.dkim_selector)
         return message
 
-    def _send(self, name, to, context, locale=None):
+    def create_connection(self):
+        """Returns smtp backend, that may be reused for multiple messages.
+        Uses flask_emails config, override this for custom message_cls"""
+        config = current_app.extensions.get('emails')
+        if config is None:
+            config = self.message_cls.init_app(current_app)
+        options = dict(config.smtp_options, fail_silently=False)
+        return config.backend_cls(**options)
+
+    def _send(self, name, to, context, locale=None, smtp=None):
         message = self.create(name, context, locale)
-        message.send(to=to)
+        if smtp is None:
+            return message.send(to=to)
+        message.set_mail_to(to)
+        return smtp.sendmail(from_addr=message.mail_from[1],
+                             to_addrs=message.get_recipients_emails(), msg=message)
+
+    def _send_batch(self, name, locale, recipients):
+        """Delivers [(to, context), ...] over one smtp connection,
+        returns failed ones"""
+        connection, failed = None, []
+        for to, context in recipients:
+            try:
+                if connection is None:
+                    connection = self.create_connection()
+                self._send(name, to, context, locale, smtp=connection)
+            except Exception:
+                current_app.logger.warning('Email sending failed: %s to %s', name, to,
+                                           exc_info=True)
+                connection = EmailQueue._close(connection)
+                failed.append((to, context))
+        EmailQueue._close(connection)
+        return failed
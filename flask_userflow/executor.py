@@ -0,0 +1,103 @@
+import time
+import threading
+from multiprocessing.pool import Pool, ThreadPool
+
+
+class ExecutorBusy(Exception):
+    """Raised when executor queue is full, so caller may fail fast"""
+
+
+def _timed_call(submitted, func, args):
+    # module level for process pool pickling
+    return time.time() - submitted, func(*args)
+
+
+def _background_call(submitted, func, args):
+    # never raises, so completion callback is always called
+    wait = time.time() - submitted
+    try:
+        return wait, func(*args), None
+    except Exception as exc:
+        return wait, None, exc
+
+
+class Executor(object):
+    """Bounded pool for CPU-heavy calls (password hashing) off the request thread"""
+
+    pool_classes = {'thread': ThreadPool, 'process': Pool}
+
+    def __init__(self, kind='thread', workers=None, queue_size=0):
+        if kind not in self.pool_classes:
+            raise ValueError('Unknown executor kind: {}'.format(kind))
+        self.pool = self.pool_classes[kind](workers)
+        self.workers = self.pool._processes
+        self.queue_size = queue_size
+
+        self._slots = threading.BoundedSemaphore(self.workers + queue_size)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.wait_time = 0.
+        self.max_wait_time = 0.
+
+    def _acquire(self):
+        if not self._slots.acquire(False):
+            with self._lock:
+                self.rejected += 1
+            raise ExecutorBusy()
+        with self._lock:
+            self.pending += 1
+            self.submitted += 1
+
+    def _release(self):
+        with self._lock:
+            self.pending -= 1
+        self._slots.release()
+
+    def _complete(self, wait):
+        with self._lock:
+            self.completed += 1
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+
+    def run(self, func, *args):
+        self._acquire()
+        try:
+            wait, result = self.pool.apply_async(_timed_call,
+                                                 (time.time(), func, args)).get()
+        finally:
+            self._release()
+        self._complete(wait)
+        return result
+
+    def submit(self, func, *args):
+        """Queues call without waiting for it, returns AsyncResult
+        of (wait time, result, exception)"""
+        self._acquire()
+
+        def callback(result):
+            self._release()
+            self._complete(result[0])
+
+        return self.pool.apply_async(_background_call, (time.time(), func, args),
+                                     callback=callback)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'pending': self.pending,
+                'queue_depth': max(0, self.pending - self.workers),
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'avg_wait_time': self.completed and self.wait_time / self.completed,
+                'max_wait_time': self.max_wait_time,
+            }
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
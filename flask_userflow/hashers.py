@@ -0,0 +1,267 @@
+import os
+import time
+import base64
+import hashlib
+import binascii
+
+import bcrypt
+from werkzeug.security import safe_str_cmp
+
+try:
+    import argon2
+except ImportError:
+    argon2 = None
+
+
+# raised when parsing malformed stored hash
+_parse_errors = (ValueError, TypeError, KeyError, binascii.Error)
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(data):
+    data = _to_bytes(data)
+    return base64.b64decode(data + b'=' * (-len(data) % 4))
+
+
+def call_hasher(hasher, method, *args):
+    # module level for process pool pickling
+    return getattr(hasher, method)(*args)
+
+
+class Hasher(object):
+    """Base password hasher, algorithm is detected by stored hash prefix"""
+
+    name = None
+    prefix = None
+    available = True
+    config_keys = ()
+
+    def __init__(self, config):
+        self.config = config
+
+    def __getstate__(self):
+        # pickle only own settings for process executor
+        return {'config': {k: self.config[k] for k in self.config_keys}}
+
+    def identify(self, password_hash):
+        return password_hash.startswith(self.prefix)
+
+    @property
+    def memory(self):
+        """Approximate memory in bytes used for one hash computation"""
+        return 0
+
+    def encrypt(self, password):
+        raise NotImplementedError()
+
+    def verify(self, password, password_hash):
+        raise NotImplementedError()
+
+    def needs_rehash(self, password_hash):
+        return False
+
+
+class BcryptHasher(Hasher):
+    name = 'bcrypt'
+    prefix = '$2'
+    config_keys = ('PASSWORD_ROUNDS', 'PASSWORD_IDENT', 'PASSWORD_REHASH_TOLERANCE')
+    memory = 4 * 1024
+
+    def encrypt(self, password):
+        salt = bcrypt.gensalt(rounds=self.config['PASSWORD_ROUNDS'],
+                              prefix=self.config['PASSWORD_IDENT'])
+        return bcrypt.hashpw(_to_bytes(password), salt).decode('utf8')
+
+    def verify(self, password, password_hash):
+        password_hash = _to_bytes(password_hash)
+        try:
+            return safe_str_cmp(bcrypt.hashpw(_to_bytes(password), password_hash),
+                                password_hash)
+        except ValueError:
+            return False
+
+    def needs_rehash(self, password_hash):
+        try:
+            _, ident, rounds, _ = password_hash.split('$', 3)
+            rounds = int(rounds)
+        except ValueError:
+            return True
+        min_rounds = self.config['PASSWORD_ROUNDS']
+        max_rounds = min_rounds + self.config['PASSWORD_REHASH_TOLERANCE']
+        return ident != self.config['PASSWORD_IDENT'] or not min_rounds <= rounds <= max_rounds
+
+
+class Pbkdf2Hasher(Hasher):
+    """Format: $pbkdf2-sha256$rounds$salt$hash"""
+
+    name = 'pbkdf2_sha256'
+    prefix = '$pbkdf2-sha256$'
+    config_keys = ('PASSWORD_PBKDF2_ROUNDS',)
+    digest = 'sha256'
+    available = hasattr(hashlib, 'pbkdf2_hmac')
+
+    def _hash(self, password, salt, rounds):
+        return hashlib.pbkdf2_hmac(self.digest, _to_bytes(password), salt, rounds)
+
+    def encrypt(self, password):
+        rounds = self.config['PASSWORD_PBKDF2_ROUNDS']
+        salt = os.urandom(16)
+        return u'{}{}${}${}'.format(self.prefix, rounds, _b64encode(salt),
+                                    _b64encode(self._hash(password, salt, rounds)))
+
+    def _parse(self, password_hash):
+        rounds, salt, hash_ = password_hash[len(self.prefix):].split('$')
+        return int(rounds), _b64decode(salt), _b64decode(hash_)
+
+    def verify(self, password, password_hash):
+        try:
+            rounds, salt, hash_ = self._parse(password_hash)
+        except _parse_errors:
+            return False
+        return safe_str_cmp(self._hash(password, salt, rounds), hash_)
+
+    def needs_rehash(self, password_hash):
+        try:
+            return self._parse(password_hash)[0] != self.config['PASSWORD_PBKDF2_ROUNDS']
+        except _parse_errors:
+            return True
+
+
+class ScryptHasher(Hasher):
+    """Format: $scrypt$ln=14,r=8,p=1$salt$hash"""
+
+    name = 'scrypt'
+    prefix = '$scrypt$'
+    config_keys = ('PASSWORD_SCRYPT_N', 'PASSWORD_SCRYPT_R', 'PASSWORD_SCRYPT_P')
+    available = hasattr(hashlib, 'scrypt')
+
+    @property
+    def params(self):
+        return (self.config['PASSWORD_SCRYPT_N'], self.config['PASSWORD_SCRYPT_R'],
+                self.config['PASSWORD_SCRYPT_P'])
+
+    @property
+    def memory(self):
+        n, r, p = self.params
+        return 128 * r * n
+
+    def _hash(self, password, salt, n, r, p):
+        return hashlib.scrypt(_to_bytes(password), salt=salt, n=n, r=r, p=p,
+                              maxmem=128 * r * (n + p + 2) + 1024 * 1024)
+
+    def _parse(self, password_hash):
+        params, salt, hash_ = password_hash[len(self.prefix):].split('$')
+        params = dict(param.split('=') for param in params.split(','))
+        return ((2 ** int(params['ln']), int(params['r']), int(params['p'])),
+                _b64decode(salt), _b64decode(hash_))
+
+    def encrypt(self, password):
+        n, r, p = self.params
+        salt = os.urandom(16)
+        return u'{}ln={},r={},p={}${}${}'.format(
+            self.prefix, n.bit_length() - 1, r, p, _b64encode(salt),
+            _b64encode(self._hash(password, salt, n, r, p)))
+
+    def verify(self, password, password_hash):
+        try:
+            params, salt, hash_ = self._parse(password_hash)
+        except _parse_errors:
+            return False
+        return safe_str_cmp(self._hash(password, salt, *params), hash_)
+
+    def needs_rehash(self, password_hash):
+        try:
+            return self._parse(password_hash)[0] != self.params
+        except _parse_errors:
+            return True
+
+
+class Argon2Hasher(Hasher):
+    """Requires argon2-cffi"""
+
+    name = 'argon2'
+    prefix = '$argon2'
+    config_keys = ('PASSWORD_ARGON2_TIME_COST', 'PASSWORD_ARGON2_MEMORY_COST',
+                   'PASSWORD_ARGON2_PARALLELISM')
+    available = argon2 is not None
+
+    @property
+    def hasher(self):
+        return argon2.PasswordHasher(
+            time_cost=self.config['PASSWORD_ARGON2_TIME_COST'],
+            memory_cost=self.config['PASSWORD_ARGON2_MEMORY_COST'],
+            parallelism=self.config['PASSWORD_ARGON2_PARALLELISM'])
+
+    @property
+    def memory(self):
+        return self.config['PASSWORD_ARGON2_MEMORY_COST'] * 1024
+
+    def encrypt(self, password):
+        return self.hasher.hash(password)
+
+    def verify(self, password, password_hash):
+        try:
+            return self.hasher.verify(password_hash, password)
+        except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHash):
+            return False
+
+    def needs_rehash(self, password_hash):
+        return self.hasher.check_needs_rehash(password_hash)
+
+
+class PasswordHashers(object):
+    """Registry of available hashers, PASSWORD_SCHEME is used for new hashes"""
+
+    hasher_classes = (BcryptHasher, Pbkdf2Hasher, ScryptHasher, Argon2Hasher)
+
+    def __init__(self, config):
+        self.config = config
+        self.hashers = []
+        for cls in self.hasher_classes:
+            if cls.name in config['PASSWORD_SCHEMES'] and cls.available:
+                self.hashers.append(cls(config))
+
+        self.default = self.get(config['PASSWORD_SCHEME'])
+        if not self.default:
+            raise ValueError('Password scheme {} is not available'
+                             .format(config['PASSWORD_SCHEME']))
+
+    def get(self, name):
+        for hasher in self.hashers:
+            if hasher.name == name:
+                return hasher
+
+    def identify(self, password_hash):
+        if password_hash:
+            for hasher in self.hashers:
+                if hasher.identify(password_hash):
+                    return hasher
+
+    def needs_rehash(self, password_hash):
+        hasher = self.identify(password_hash)
+        if hasher is not self.default:
+            return True
+        return hasher.needs_rehash(password_hash)
+
+    def benchmark(self, duration=1., password='benchmark'):
+        """Returns hashes per second and memory per hash for each hasher"""
+        result = {}
+        for hasher in self.hashers:
+            count, started = 0, time.time()
+            while not count or time.time() - started < duration:
+                hasher.encrypt(password)
+                count += 1
+            result[hasher.name] = {
+                'hashes_per_sec': count / (time.time() - started),
+                'memory': hasher.memory,
+            }
+        return result
@@ -0,0 +1,249 @@
+import os
+import time
+import heapq
+import atexit
+import itertools
+import threading
+from Queue import Queue, Empty
+from collections import OrderedDict
+
+from flask import current_app
+
+
+class EmailQueue(object):
+    """In-process delivery queue for Emails without celery.
+
+    Worker threads keep SMTP connection open while there are messages
+    to send, take up to batch_size queued messages at once and deliver
+    them over the same connection. Failed messages are requeued for retry
+    with exponential backoff, not blocking other messages. Queue is drained
+    on interpreter shutdown, pending retries are counted as failed then.
+    """
+
+    def __init__(self, emails, workers=1, batch_size=20, retries=3, backoff=1.,
+                 idle_timeout=30):
+        self.emails = emails
+        self.workers = workers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+
+        self._queue = Queue()
+        self._delayed = []  # heap of (not before time, counter, job)
+        self._counter = itertools.count()
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+        self.sent = 0
+        self.failed = 0
+        self.connections = 0
+
+    def send(self, name, to, context, locale=None):
+        self._start()
+        self._queue.put((current_app._get_current_object(), (name, to, context, locale), 0))
+
+    def _start(self):
+        # threads are started lazily and restarted in forked process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._threads = []
+                for _ in range(self.workers):
+                    thread = threading.Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+                if self._pid is None:
+                    atexit.register(self.stop)
+                self._pid = os.getpid()
+
+    def join(self):
+        """Blocks until all queued messages are processed (including retries)"""
+        self._queue.join()
+
+    def stop(self, timeout=None):
+        """Delivers queued messages and stops workers"""
+        if self._pid != os.getpid():
+            return
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._pid = None
+
+        with self._lock:
+            delayed, self._delayed = self._delayed, []
+        for _, _, (app, args, attempt) in delayed:
+            self.failed += 1
+            app.logger.error('Email sending failed: %s to %s, not retried on shutdown',
+                             args[0], args[1])
+            self._queue.task_done()
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            'queued': len(self),
+            'sent': self.sent,
+            'failed': self.failed,
+            'connections': self.connections,
+        }
+
+    def _schedule_due(self):
+        """Moves due retries to queue, returns timeout for waiting next message"""
+        now = time.time()
+        with self._lock:
+            while self._delayed and self._delayed[0][0] <= now:
+                job = heapq.heappop(self._delayed)[2]
+                self._queue.put(job)
+                # delayed job was not marked done, so join waits for retries
+                self._queue.task_done()
+            if self._delayed:
+                return min(self.idle_timeout, self._delayed[0][0] - now)
+        return self.idle_timeout
+
+    def _delay(self, job, delay):
+        with self._lock:
+            heapq.heappush(self._delayed, (time.time() + delay, next(self._counter), job))
+
+    def _get_batch(self):
+        jobs = [self._queue.get(timeout=self._schedule_due())]
+        while jobs[-1] is not None and len(jobs) < self.batch_size:
+            try:
+                jobs.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return jobs
+
+    def _work(self):
+        connection = None
+        while True:
+            try:
+                jobs = self._get_batch()
+            except Empty:
+                if not self._delayed:
+                    # idle, do not keep connection
+                    connection = self._close(connection)
+                continue
+
+            finished = 0
+            for job in jobs:
+                if job is None:
+                    # sentinel is the last job of batch
+                    self._close(connection)
+                    for _ in range(finished + 1):
+                        self._queue.task_done()
+                    return
+                connection, delayed = self._deliver(connection, *job)
+                if not delayed:
+                    # delayed job is marked done when moved back to queue
+                    finished += 1
+            for _ in range(finished):
+                self._queue.task_done()
+
+    def _deliver(self, connection, app, args, attempt):
+        """Returns (connection, True if message is delayed for retry)"""
+        with app.app_context():
+            try:
+                if connection is None:
+                    connection = self.emails.create_connection()
+                    self.connections += 1
+                self.emails._send(*args, smtp=connection)
+                self.sent += 1
+                return connection, False
+            except Exception:
+                connection = self._close(connection)
+                if attempt >= self.retries:
+                    self.failed += 1
+                    app.logger.exception('Email sending failed: %s to %s', args[0], args[1])
+                    self.emails.discard_outbox(args[0], args[1])
+                    return connection, False
+            self._delay((app, args, attempt + 1), self.backoff * 2 ** attempt)
+            return connection, True
+
+    @staticmethod
+    def _close(connection):
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+class EmailBatcher(object):
+    """Buffers Emails.send calls and dispatches them to celery as batch tasks.
+
+    Buffer is flushed when batch_size messages are collected or after delay
+    seconds. Messages are grouped by template name and locale, so each task
+    payload is (name, locale, [(to, context), ...]).
+    """
+
+    def __init__(self, task, batch_size=50, delay=1.):
+        self.task = task
+        self.batch_size = batch_size
+        self.delay = delay
+
+        self._buffer = []  # (app, name, locale, to, context)
+        self._timer = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        self.messages = 0
+        self.tasks = 0
+
+    def send(self, name, to, context, locale=None):
+        with self._lock:
+            if self._pid != os.getpid():
+                # do not flush parent process messages from forked process
+                if self._pid is None:
+                    atexit.register(self.flush)
+                self._pid = os.getpid()
+                self._buffer, self._timer = [], None
+            self._buffer.append((current_app._get_current_object(), name, locale, to, context))
+            self.messages += 1
+            if len(self._buffer) < self.batch_size:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            buffer = self._take()
+        self._dispatch(buffer)
+
+    def flush(self):
+        """Dispatches buffered messages immediately"""
+        with self._lock:
+            buffer = self._take()
+        self._dispatch(buffer)
+
+    def _take(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        buffer, self._buffer = self._buffer, []
+        return buffer
+
+    def _dispatch(self, buffer):
+        batches = OrderedDict()
+        for app, name, locale, to, context in buffer:
+            batches.setdefault((app, name, locale), []).append((to, context))
+
+        for (app, name, locale), recipients in batches.items():
+            with app.app_context():
+                for i in range(0, len(recipients), self.batch_size):
+                    self.task.delay(name, locale, recipients[i:i + self.batch_size])
+                    self.tasks += 1
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def stats(self):
+        return {
+            'buffered': len(self),
+            'messages': self.messages,
+            'tasks': self.tasks,
+        }
@@ -57,29 +57,32 @@ class UserMixin(I18NMixin, UserMixin):
 
     def get_auth_token(self):
         """Returns the user's authentication token."""
-        return _userflow.auth_token_serializer.dumps(self.auth_id)
+        return _userflow.get_auth_token(self)
 
     def set_password(self, password):
         self.password = _userflow.encrypt_password(password)
+        _userflow.invalidate_user(self.auth_id)
 
     def verify_password(self, password):
         return _userflow.verify_password(password, self.password)
 
+    def password_needs_rehash(self):
+        return _userflow.password_needs_rehash(self.password)
+
     def get_id(self):
         return self.auth_id
 
     def generate_auth_id(self):
         """This also may be used to invalidate all current sessions"""
         assert self.password
+        auth_id = self.auth_id
         self.auth_id = md5('%s%s%s' % (str(self.id), self.password,
                                        datetime.utcnow().isoformat()))
+        _userflow.invalidate_user(auth_id)
 
     @property
     def roles(self):
-        if not _userflow.datastore.role_model:
-            raise NotImplementedError('Implement this or add role_model to datastore')
-        roles = _userflow._datastore.find_roles(user_id=self.id)
-        return [role.name for role in roles]
+        return _userflow.get_roles(self)
 
     def add_role(self, name):
         if not _userflow.datastore.role_model:
@@ -87,6 +90,7 @@ class UserMixin(I18NMixin, UserMixin):
         role = _userflow.datastore.create_role(name=name, user_id=self.id)
         _userflow.datastore.put(role)
         _userflow.datastore.commit()
+        _userflow.invalidate_roles(self.id)
 
     def delete_role(self, name):
         if not _userflow.datastore.role_model:
@@ -96,7 +100,36 @@ class UserMixin(I18NMixin, UserMixin):
         for role in roles:
             _userflow.datastore.delete(role)
         _userflow.datastore.commit()
+        _userflow.invalidate_roles(self.id)
 
     def has_role(self, *args):
         roles = self.roles
         return all(r in roles for r in args)
+
+
+class TokenUser(UserMixin):
+    """User loaded from stateless auth token without datastore query.
+    Attributes missing in token are read from user loaded by auth_id"""
+
+    # shadow UserMixin properties with token fields
+    id = auth_id = locale = timezone = None
+
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+    @property
+    def roles(self):
+        roles = self.__dict__.get('roles')
+        return roles if roles is not None else self._user.roles
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._user, name)
+
+    @cached_property
+    def _user(self):
+        user = _userflow.get_user(auth_id=self.auth_id)
+        if user is None:
+            raise AttributeError('User with auth_id {} does not exist'.format(self.auth_id))
+        return user
@@ -0,0 +1,84 @@
+import time
+import threading
+
+
+class MemoryOutboxStore(object):
+    """In-process index of recently sent emails, key: expiration time"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._expires)
+
+    def add(self, key, window, now=None):
+        """Returns False if key was added less than window seconds ago"""
+        now = now or time.time()
+        with self._lock:
+            if self._expires.get(key, 0) > now:
+                return False
+            self._expires[key] = now + window
+            if len(self._expires) > self.max_keys:
+                self._prune(now)
+        return True
+
+    def discard(self, key):
+        with self._lock:
+            self._expires.pop(key, None)
+
+    def _prune(self, now):
+        for key, expires in list(self._expires.items()):
+            if expires < now:
+                del self._expires[key]
+        while len(self._expires) > self.max_keys * 0.9:
+            self._expires.popitem()
+
+
+class RedisOutboxStore(object):
+    """Shared store for multiple workers, accepts redis client instance"""
+
+    def __init__(self, redis, prefix='userflow:outbox:'):
+        self.redis = redis
+        self.prefix = prefix
+
+    def add(self, key, window, now=None):
+        return bool(self.redis.set(u'{}{}'.format(self.prefix, key), 1,
+                                   nx=True, ex=int(window)))
+
+    def discard(self, key):
+        self.redis.delete(u'{}{}'.format(self.prefix, key))
+
+
+class Outbox(object):
+    """Coalesces sends of same EMAIL_OUTBOX_TEMPLATES email to same recipient
+    within EMAIL_OUTBOX_WINDOW seconds"""
+
+    def __init__(self, config, store=None):
+        self.window = config['EMAIL_OUTBOX_WINDOW']
+        self.templates = config['EMAIL_OUTBOX_TEMPLATES']
+        if store is None:
+            store = MemoryOutboxStore(config['EMAIL_OUTBOX_MAX_KEYS'])
+        self.store = store
+        self.suppressed = 0
+
+    def add(self, name, to):
+        """Returns False if email is duplicate and should not be sent"""
+        if name not in self.templates:
+            return True
+        if self.store.add(u'{}:{}'.format(name, to.lower()), self.window):
+            return True
+        self.suppressed += 1
+        return False
+
+    def discard(self, name, to):
+        """Forgets failed email, so it may be sent again"""
+        if name in self.templates:
+            self.store.discard(u'{}:{}'.format(name, to.lower()))
+
+    def stats(self):
+        return {
+            'keys': len(self.store) if hasattr(self.store, '__len__') else None,
+            'suppressed': self.suppressed,
+        }
@@ -4,6 +4,18 @@ import pytz
 from ua_parser import user_agent_parser
 from flask import request, session, _app_ctx_stack as stack
 
+from .utils import next_dst_transition, ip_network_key
+from .cache import LRUCache
+
+try:
+    from geoip2.errors import AddressNotFoundError
+except ImportError:
+    class AddressNotFoundError(Exception):
+        pass
+
+WARMUP_USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                     '(KHTML, like Gecko) Chrome/70.0.3538.77 Safari/537.36')
+
 
 class RequestUtils(object):
     geoip = None  # https://github.com/vgavro/flask-geoip2/
@@ -13,6 +25,17 @@ class RequestUtils(object):
         self.config = config
         if geoip:
             self.geoip = geoip
+        self._tz_offset_index = None
+
+        self.ua_cache = None
+        if config['UA_CACHE_SIZE']:
+            self.ua_cache = LRUCache(config['UA_CACHE_SIZE'])
+        if config['UA_PARSER_WARMUP']:
+            self.warmup_ua_parser()
+
+        self.geoip_cache = None
+        if config['GEOIP_CACHE_SIZE']:
+            self.geoip_cache = LRUCache(config['GEOIP_CACHE_SIZE'], config['GEOIP_CACHE_TTL'])
 
     def get_remote_addr(self):
         address = request.headers.get('X-Forwarded-For', request.remote_addr)
@@ -35,16 +58,45 @@ class RequestUtils(object):
                     pass
 
         elif browser_tz_offset:
-            offset = timedelta(minutes=browser_tz_offset)
-            now = datetime.now(pytz.utc)
-            timezones = {now.astimezone(tz).tzname()
-                         for tz in map(pytz.timezone, pytz.all_timezones_set)
-                         if now.astimezone(tz).utcoffset() == offset}
+            timezones = self.get_tz_offset_index().get(int(browser_tz_offset))
             if timezones:
                 return timezones[0]
 
         return self.config['DEFAULT_TIMEZONE']
 
+    def _rank_timezone(self, tz, primary, countries):
+        # no population data in pytz, so PREFERRED_TIMEZONES go first,
+        # then country primary zones, common zones, zones shared by more countries
+        preferred = self.config['PREFERRED_TIMEZONES']
+        return (preferred.index(tz) if tz in preferred else len(preferred),
+                tz not in primary, tz not in pytz.common_timezones_set,
+                -countries.get(tz, 0), tz)
+
+    def get_tz_offset_index(self):
+        """Returns {utc offset minutes: [timezones ranked by commonness]},
+        rebuilt after nearest DST transition"""
+        now = datetime.utcnow()
+        if self._tz_offset_index and self._tz_offset_index[0] > now:
+            return self._tz_offset_index[1]
+
+        primary, countries = set(), {}
+        for zones in pytz.country_timezones.values():
+            primary.add(zones[0])
+            for tz in zones:
+                countries[tz] = countries.get(tz, 0) + 1
+
+        index = {}
+        utcnow = pytz.utc.localize(now)
+        for tz in pytz.all_timezones_set:
+            offset = utcnow.astimezone(pytz.timezone(tz)).utcoffset()
+            index.setdefault(int(offset.total_seconds()) // 60, []).append(tz)
+        for timezones in index.values():
+            timezones.sort(key=lambda tz: self._rank_timezone(tz, primary, countries))
+
+        expires = next_dst_transition(pytz.all_timezones_set, now)
+        self._tz_offset_index = (expires or now + timedelta(days=365), index)
+        return index
+
     def guess_locale(self, geoip_info=None, browser_locales=None):
         if self.config['LOCALES']:
             locale = request.accept_languages.best_match(self.config['LOCALES'])
@@ -89,27 +141,63 @@ class RequestUtils(object):
 
     def get_geoip_info(self):
         ctx = stack.top
-        empty = {'country': None, 'city': None, 'lat': None, 'lng': None, 'timezone': None}
         if ctx is not None:
             if not hasattr(ctx, '_geoip_info'):
-                remote_addr = self.get_remote_addr()
-                if not self.geoip:
-                    raise RuntimeError('Override this method or configure it '
-                                       'with flask_geoip2 instance')
-                try:
-                    r = self.geoip.city(remote_addr)
-                    ctx._geoip_info = {
-                        'country': r.country.iso_code,
-                        'city': r.city.name,
-                        'lat': r.location.latitude,
-                        'lng': r.location.longitude,
-                        'timezone': r.location.time_zone,
-                    }
-                except r.AddressNotFoundError:
-                    ctx._geoip_info = empty
+                ctx._geoip_info = self.lookup_geoip_info(self.get_remote_addr())
             return ctx._geoip_info
-        return empty
+        return self._empty_geoip_info()
+
+    @staticmethod
+    def _empty_geoip_info():
+        return {'country': None, 'city': None, 'lat': None, 'lng': None, 'timezone': None}
+
+    def lookup_geoip_info(self, remote_addr):
+        """Note: result may be shared between requests, do not modify it"""
+        if not self.geoip:
+            raise RuntimeError('Override this method or configure it '
+                               'with flask_geoip2 instance')
+
+        key = ip_network_key(remote_addr, self.config['GEOIP_CACHE_IPV4_PREFIX'],
+                             self.config['GEOIP_CACHE_IPV6_PREFIX'])
+        if self.geoip_cache is not None:
+            geoip_info = self.geoip_cache.get(key)
+            if geoip_info is not None:
+                return geoip_info
+
+        ttl = None
+        try:
+            r = self.geoip.city(remote_addr)
+            geoip_info = {
+                'country': r.country.iso_code,
+                'city': r.city.name,
+                'lat': r.location.latitude,
+                'lng': r.location.longitude,
+                'timezone': r.location.time_zone,
+            }
+        except AddressNotFoundError:
+            geoip_info = self._empty_geoip_info()
+            ttl = self.config['GEOIP_CACHE_NEGATIVE_TTL']
+
+        if self.geoip_cache is not None:
+            self.geoip_cache.set(key, geoip_info, ttl)
+        return geoip_info
+
+    def warmup_ua_parser(self):
+        """Parses sample, so regexes are loaded and compiled on app start"""
+        user_agent_parser.Parse(WARMUP_USER_AGENT)
 
     def get_ua_info(self):
+        """Note: result may be shared between requests, do not modify it"""
         ua = request.headers.get('User-Agent')
-        return ua and user_agent_parser.Parse(ua) or None
+        if not ua:
+            return None
+        if self.config['UA_MAX_LENGTH']:
+            ua = ua[:self.config['UA_MAX_LENGTH']]
+        if self.ua_cache is None:
+            return user_agent_parser.Parse(ua)
+
+        ua_info = self.ua_cache.get(ua)
+        if ua_info is None:
+            ua_info = user_agent_parser.Parse(ua)
+            self.ua_cache.set(ua, ua_info)
+        return ua_info
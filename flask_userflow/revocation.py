@@ -0,0 +1,184 @@
+import math
+import time
+import struct
+import hashlib
+import threading
+
+
+class BloomFilter(object):
+    """Fixed size Bloom filter for capacity items with error_rate false positives"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        # double hashing with two 64 bit halves of md5
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, positions):
+        for pos in positions:
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, positions):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in positions)
+
+    @property
+    def memory(self):
+        return len(self._bits)
+
+
+class MemoryRevocationStore(object):
+    """Exact in-process store, token id: (added time, expiration time)"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, token_id, expires):
+        now = time.time()
+        with self._lock:
+            self._entries[token_id] = (now, expires)
+            # amortized pruning of expired entries
+            if len(self._entries) % 1000 == 0:
+                for key, (added, value) in list(self._entries.items()):
+                    if value < now:
+                        del self._entries[key]
+
+    def contains(self, token_id):
+        return self._entries.get(token_id, (0, 0))[1] >= time.time()
+
+    def added_since(self, timestamp):
+        now = time.time()
+        with self._lock:
+            return [(token_id, expires) for token_id, (added, expires) in self._entries.items()
+                    if added >= timestamp and expires >= now]
+
+
+class RedisRevocationStore(object):
+    """Shared store for multiple workers, accepts redis client instance.
+    Keeps log of not expired revocations (by added time, and by expiration
+    time for trimming) to sync Bloom filters of other workers"""
+
+    def __init__(self, redis, prefix='userflow:revoked:'):
+        self.redis = redis
+        self.prefix = prefix
+
+    def add(self, token_id, expires):
+        now = time.time()
+        log_key, expires_key = u'{}log'.format(self.prefix), u'{}expires'.format(self.prefix)
+        entry = u'{}:{}'.format(token_id, expires)
+        pipe = self.redis.pipeline()
+        pipe.set(u'{}{}'.format(self.prefix, token_id), 1,
+                 ex=max(1, int(math.ceil(expires - now))))
+        pipe.zadd(log_key, {entry: now})
+        pipe.zadd(expires_key, {entry: expires})
+        pipe.zrangebyscore(expires_key, 0, now)
+        expired = pipe.execute()[-1]
+        if expired:
+            pipe = self.redis.pipeline()
+            pipe.zrem(log_key, *expired)
+            pipe.zrem(expires_key, *expired)
+            pipe.execute()
+
+    def contains(self, token_id):
+        return bool(self.redis.exists(u'{}{}'.format(self.prefix, token_id)))
+
+    def added_since(self, timestamp):
+        """Returns [(token_id, expires)] added after timestamp"""
+        entries = self.redis.zrangebyscore(u'{}log'.format(self.prefix), timestamp, '+inf')
+        return [(entry.decode('ascii') if isinstance(entry, bytes) else entry).rsplit(':', 1)
+                for entry in entries]
+
+
+class RevocationSet(object):
+    """Revoked token ids with expiration time.
+
+    Ids are added to Bloom filter of time bucket by expiration time
+    and to exact store. Check costs one md5 and few bit tests for not
+    revoked tokens, exact store is queried only on Bloom filter match.
+    Buckets (and store entries) are dropped when expired.
+    """
+
+    def __init__(self, config, store=None):
+        self.bucket_time = config['AUTH_TOKEN_REVOCATION_BUCKET']
+        self.capacity = config['AUTH_TOKEN_REVOCATION_CAPACITY']
+        self.error_rate = config['AUTH_TOKEN_REVOCATION_ERROR_RATE']
+        self.sync_interval = config['AUTH_TOKEN_REVOCATION_SYNC']
+        self.store = store if store is not None else MemoryRevocationStore()
+
+        self._buckets = {}  # bucket index: BloomFilter
+        self._synced = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+        self.checks = 0
+        self.store_checks = 0
+        self.revoked = 0
+
+    def add(self, token_id, expires):
+        self.store.add(token_id, expires)
+        self._add(token_id, expires)
+
+    def _add(self, token_id, expires):
+        index = int(expires // self.bucket_time)
+        with self._lock:
+            bloom = self._buckets.get(index)
+            if bloom is None:
+                bloom = self._buckets[index] = BloomFilter(self.capacity, self.error_rate)
+            bloom.add(bloom.positions(token_id))
+
+    def _expire(self, now):
+        with self._lock:
+            for index in list(self._buckets):
+                if (index + 1) * self.bucket_time < now:
+                    del self._buckets[index]
+
+    def _sync(self, now):
+        if self._synced is not None and now - self._synced < self.sync_interval:
+            return
+        with self._sync_lock:
+            synced = self._synced
+            if synced is not None and now - synced < self.sync_interval:
+                return
+            # first check loads all not expired revocations (added before this worker
+            # started), overlap covers clock differences between workers
+            since = 0 if synced is None else synced - self.sync_interval
+            for token_id, expires in self.store.added_since(since):
+                if float(expires) >= now:
+                    self._add(token_id, float(expires))
+            self._synced = now
+        self._expire(now)
+
+    def __contains__(self, token_id):
+        now = time.time()
+        self._sync(now)
+        self.checks += 1
+        positions = None
+        for bloom in list(self._buckets.values()):
+            if positions is None:
+                positions = bloom.positions(token_id)
+            if positions in bloom:
+                self.store_checks += 1
+                if self.store.contains(token_id):
+                    self.revoked += 1
+                    return True
+                return False
+        return False
+
+    def stats(self):
+        return {
+            'buckets': len(self._buckets),
+            'entries': sum(bloom.count for bloom in self._buckets.values()),
+            'memory': sum(bloom.memory for bloom in self._buckets.values()),
+            'checks': self.checks,
+            'store_checks': self.store_checks,
+            'revoked': self.revoked,
+        }
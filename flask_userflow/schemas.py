@@ -27,7 +27,7 @@ class TokenMixin(object):
 
 class UserMixin(object):
     def _get_user(self, email):
-        return _userflow.datastore.find_user(email=email)
+        return _userflow.get_user(email=email)
 
 
 class UnregisteredEmailMixin(UserMixin):
@@ -97,6 +97,8 @@ class LoginSchema(RegisteredEmailMixin, PasswordMixin, BaseSchema):
             raise ma.ValidationError('INVALID_PASSWORD', field_names=['password'])
         if not user.is_active:
             raise ma.ValidationError('DISABLED_ACCOUNT')
+        if _userflow.config['PASSWORD_REHASH'] and user.password_needs_rehash():
+            _userflow.rehash_password(user, data['password'])
 
         data.setdefault('remember', False)
         return user, data
@@ -168,6 +170,77 @@ class ProviderUserSchema(BaseSchema):
     provider_user_id = ma.fields.Str(required=True)
 
 
+class CompiledSchema(object):
+    """Dump-only wrapper generating serializer function from schema fields
+    at startup, with direct attribute access for Str and Int fields,
+    other fields are serialized by marshmallow field itself.
+
+    Unlike schema.dump, field errors are raised instead of collected.
+    Other attributes are proxied to schema.
+    """
+
+    def __init__(self, schema):
+        if schema.many or type(schema).get_attribute != ma.Schema.get_attribute:
+            raise ValueError('Schema {} can not be compiled'.format(type(schema).__name__))
+        if any(tag in ('pre_dump', 'post_dump') and processors
+               for (tag, pass_many), processors in schema.__processors__.items()):
+            raise ValueError('Schema {} has dump processors'.format(type(schema).__name__))
+        self.schema = schema
+        self.source, namespace = self._generate(schema)
+        exec(compile(self.source, '<{}>'.format(type(schema).__name__), 'exec'), namespace)
+        self._dump = namespace['dump']
+
+    @staticmethod
+    def _generate(schema):
+        namespace = {'missing': ma.missing, 'text': ma.utils.ensure_text_type,
+                     'get_attribute': schema.get_attribute}
+        lines = ['def dump(obj):', '    data = {}']
+        for i, (name, field) in enumerate(schema.fields.items()):
+            if field.load_only:
+                continue
+            attr, key = field.attribute or name, field.dump_to or name
+            namespace['field{}'.format(i)] = field
+            namespace['default{}'.format(i)] = field.default
+
+            # subclasses like Email may validate on serialization
+            if type(field) is ma.fields.String:
+                convert = 'text(value)'
+            elif type(field) is ma.fields.Integer and not field.as_string:
+                convert = 'int(value)'
+            else:
+                convert = None
+            if convert is None or '.' in attr:
+                lines.extend([
+                    '    value = field{}.serialize({!r}, obj, accessor=get_attribute)'
+                    .format(i, attr),
+                    '    if value is not missing:',
+                    '        data[{!r}] = value'.format(key),
+                ])
+                continue
+
+            lines.append('    value = getattr(obj, {!r}, missing)'.format(attr))
+            if field.default is ma.missing:
+                lines.append('    if value is not missing:')
+            else:
+                lines.extend([
+                    '    if value is missing:',
+                    '        data[{!r}] = default{}{}'.format(
+                        key, i, '()' if callable(field.default) else ''),
+                    '    else:',
+                ])
+            lines.append('        data[{!r}] = None if value is None else {}'.format(key, convert))
+        lines.append('    return data')
+        return '\n'.join(lines) + '\n', namespace
+
+    def dump(self, obj, many=None, **kwargs):
+        if many:
+            return ma.MarshalResult([self._dump(item) for item in obj], {})
+        return ma.MarshalResult(self._dump(obj), {})
+
+    def __getattr__(self, name):
+        return getattr(self.schema, name)
+
+
 schemas_map = {
     'set_i18n': SetI18nSchema(),
 
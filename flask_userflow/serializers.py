@@ -0,0 +1,125 @@
+import hmac
+import time
+import base64
+import struct
+import hashlib
+import binascii
+from datetime import datetime
+
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from werkzeug.security import safe_str_cmp
+
+from .hashers import _to_bytes
+
+
+class KeyedSerializer(object):
+    """URLSafeTimedSerializer with versioned keys, token is prefixed with key id
+    ("{key_id}.{token}"), so verification selects key without trying others.
+
+    Keys are (key_id, secret_key) or (key_id, secret_key, retire_at) tuples,
+    retired keys (retire_at in past, naive UTC datetime) are not accepted.
+    Newest not retired key is used for signing. Tokens without key id are
+    verified with key 0, if present.
+    """
+
+    serializer_cls = URLSafeTimedSerializer
+
+    def __init__(self, keys, salt=None):
+        self.serializers = {}
+        self.retire_at = {}
+        for key in keys:
+            key_id, secret_key, retire_at = (tuple(key) + (None,))[:3]
+            self.serializers[int(key_id)] = self.serializer_cls(secret_key, salt=salt)
+            self.retire_at[int(key_id)] = retire_at
+        if not self.serializers:
+            raise ValueError('No keys')
+
+    @property
+    def key_id(self):
+        now = datetime.utcnow()
+        active = [key_id for key_id, retire_at in self.retire_at.items()
+                  if not retire_at or retire_at > now]
+        if not active:
+            raise ValueError('All keys are retired')
+        return max(active)
+
+    def dumps(self, obj):
+        key_id = self.key_id
+        return '{}.{}'.format(key_id, self.serializers[key_id].dumps(obj))
+
+    def loads(self, token, **kwargs):
+        key_id, _, signed = token.partition('.')
+        if not key_id.isdigit():
+            key_id, signed = 0, token
+        key_id = int(key_id)
+        serializer = self.serializers.get(key_id)
+        if serializer is None:
+            raise BadSignature('Unknown key id {}'.format(key_id))
+        retire_at = self.retire_at[key_id]
+        if retire_at and retire_at <= datetime.utcnow():
+            raise BadSignature('Key {} is retired'.format(key_id))
+        return serializer.loads(signed, **kwargs)
+
+
+class CompactTokenSerializer(object):
+    """Binary token for md5 hex auth_id: version, key id, issued at (uint32),
+    16 bytes of auth_id and truncated HMAC-SHA256 of them, in base64url.
+
+    Keys are the same as for KeyedSerializer, key id should fit one byte.
+    Tokens with "." are passed to fallback serializer, if any.
+    """
+
+    version = 1
+    layout = struct.Struct('>BBI16s')
+
+    def __init__(self, keys, salt=None, mac_size=16, fallback=None):
+        self.mac_size = mac_size
+        self.fallback = fallback
+        self.keys = {}
+        self.retire_at = {}
+        for key in keys:
+            key_id, secret_key, retire_at = (tuple(key) + (None,))[:3]
+            # derive key per salt, like itsdangerous does
+            self.keys[int(key_id)] = hmac.new(_to_bytes(secret_key), _to_bytes(salt or ''),
+                                              hashlib.sha256).digest()
+            self.retire_at[int(key_id)] = retire_at
+
+    key_id = KeyedSerializer.key_id
+
+    def _mac(self, key_id, payload):
+        return hmac.new(self.keys[key_id], payload, hashlib.sha256).digest()[:self.mac_size]
+
+    def dumps(self, auth_id):
+        key_id = self.key_id
+        payload = self.layout.pack(self.version, key_id, int(time.time()),
+                                   binascii.unhexlify(auth_id))
+        token = base64.urlsafe_b64encode(payload + self._mac(key_id, payload))
+        return token.rstrip(b'=').decode('ascii')
+
+    def loads(self, token, max_age=None, return_timestamp=False):
+        if '.' in token and self.fallback is not None:
+            return self.fallback.loads(token, max_age=max_age,
+                                       return_timestamp=return_timestamp)
+        try:
+            token = _to_bytes(token)
+            data = base64.urlsafe_b64decode(token + b'=' * (-len(token) % 4))
+            version, key_id, issued, auth_id = self.layout.unpack_from(data)
+        except (TypeError, ValueError, struct.error):
+            raise BadSignature('Malformed token')
+        if version != self.version or len(data) != self.layout.size + self.mac_size:
+            raise BadSignature('Malformed token')
+        if key_id not in self.keys:
+            raise BadSignature('Unknown key id {}'.format(key_id))
+        retire_at = self.retire_at[key_id]
+        if retire_at and retire_at <= datetime.utcnow():
+            raise BadSignature('Key {} is retired'.format(key_id))
+        payload, mac = data[:self.layout.size], data[self.layout.size:]
+        if not safe_str_cmp(self._mac(key_id, payload), mac):
+            raise BadSignature('Signature does not match')
+        if max_age is not None and time.time() - issued > max_age:
+            raise SignatureExpired('Token expired')
+
+        auth_id = binascii.hexlify(auth_id).decode('ascii')
+        if return_timestamp:
+            return auth_id, datetime.utcfromtimestamp(issued)
+        return auth_id
@@ -8,21 +8,151 @@ class LazyValue(object):
 
 default_config = (
     ('SECRET_KEY', LazyValue(lambda c, app_c: app_c['SECRET_KEY'])),
+    # versioned token signing keys [(key_id, secret_key, retire_at datetime or None)],
+    # add (0, old SECRET_KEY, retire_at) to accept tokens issued before rotation
+    ('SECRET_KEYS', None),
+    # scheme for new hashes, others from PASSWORD_SCHEMES are verified by hash prefix
+    ('PASSWORD_SCHEME', 'bcrypt'),
+    ('PASSWORD_SCHEMES', ('bcrypt', 'pbkdf2_sha256', 'scrypt', 'argon2')),
     ('PASSWORD_ROUNDS', 12),
     ('PASSWORD_IDENT', '2b'),
+    ('PASSWORD_PBKDF2_ROUNDS', 100000),
+    ('PASSWORD_SCRYPT_N', 2 ** 14),
+    ('PASSWORD_SCRYPT_R', 8),
+    ('PASSWORD_SCRYPT_P', 1),
+    # argon2 requires argon2-cffi, memory cost is in KiB
+    ('PASSWORD_ARGON2_TIME_COST', 2),
+    ('PASSWORD_ARGON2_MEMORY_COST', 102400),
+    ('PASSWORD_ARGON2_PARALLELISM', 8),
+    # pick PASSWORD_ROUNDS on startup to fit PASSWORD_CALIBRATE_TIME (seconds)
+    ('PASSWORD_CALIBRATE', False),
+    ('PASSWORD_CALIBRATE_TIME', 0.25),
+    ('PASSWORD_CALIBRATE_MIN_ROUNDS', 10),
+    ('PASSWORD_CALIBRATE_MAX_ROUNDS', 16),
+    # rehash on login if stored hash scheme or cost differs from config
+    ('PASSWORD_REHASH', True),
+    # bcrypt hashes with up to this more rounds than PASSWORD_ROUNDS are not rehashed,
+    # so hosts calibrated slightly differently do not rehash passwords of each other
+    ('PASSWORD_REHASH_TOLERANCE', 1),
+    # background rehash pool, rehash is skipped (until next login) if queue is full
+    ('PASSWORD_REHASH_WORKERS', 1),
+    ('PASSWORD_REHASH_QUEUE_SIZE', 16),
+    # 'thread' or 'process' to offload hashing from request thread
+    ('PASSWORD_EXECUTOR', None),
+    ('PASSWORD_EXECUTOR_WORKERS', None),
+    ('PASSWORD_EXECUTOR_QUEUE_SIZE', 16),
 
     ('DKIM_KEY', LazyValue(lambda c, app_c: app_c.get('EMAIL_DKIM_KEY'))),
     ('DKIM_KEY_PATH', LazyValue(lambda c, app_c: app_c.get('EMAIL_DKIM_KEY_PATH'))),
     ('DKIM_DOMAIN', LazyValue(lambda c, app_c: app_c.get('EMAIL_DKIM_DOMAIN'))),
     ('DKIM_SELECTOR', LazyValue(lambda c, app_c: app_c.get('EMAIL_DKIM_SELECTOR'))),
 
+    # in-process background delivery, if celery is not configured
+    ('EMAIL_QUEUE', False),
+    ('EMAIL_QUEUE_WORKERS', 1),
+    ('EMAIL_QUEUE_BATCH_SIZE', 20),
+    ('EMAIL_QUEUE_RETRIES', 3),
+    ('EMAIL_QUEUE_BACKOFF', 1.),
+    ('EMAIL_QUEUE_IDLE_TIMEOUT', 30),
+    # buffer celery messages and send them as batch tasks over one connection,
+    # EMAIL_QUEUE_RETRIES and EMAIL_QUEUE_BACKOFF are used for failed ones
+    ('EMAIL_CELERY_BATCH', False),
+    ('EMAIL_CELERY_BATCH_SIZE', 50),
+    ('EMAIL_CELERY_BATCH_DELAY', 1.),
+    # do not send same email to same recipient twice within window seconds (0 to disable),
+    # failed email is not counted
+    ('EMAIL_OUTBOX_WINDOW', 0),
+    ('EMAIL_OUTBOX_TEMPLATES', ('register_start', 'restore_start')),
+    ('EMAIL_OUTBOX_MAX_KEYS', 100000),
+
     ('LOCALES', LazyValue(lambda c, app_c: app_c.get('LOCALES', ['en']))),
     ('DEFAULT_LOCALE', LazyValue(lambda c, app_c: app_c.get('DEFAULT_LOCALE', c['LOCALES'][0]))),
     ('DEFAULT_TIMEZONE', LazyValue(lambda c, app_c: app_c.get('DEFAULT_TIMEZONE', 'UTC'))),
+    # ranked first when guessing timezone by browser utc offset
+    ('PREFERRED_TIMEZONES', (
+        'America/New_York', 'America/Chicago', 'America/Denver', 'America/Los_Angeles',
+        'America/Mexico_City', 'America/Sao_Paulo', 'Europe/London', 'Europe/Berlin',
+        'Europe/Kiev', 'Europe/Moscow', 'Asia/Dubai', 'Asia/Karachi', 'Asia/Kolkata',
+        'Asia/Dhaka', 'Asia/Jakarta', 'Asia/Shanghai', 'Asia/Tokyo', 'Australia/Sydney',
+    )),
+
+    # parsed user agents LRU cache, 0 to disable, long headers are truncated
+    ('UA_CACHE_SIZE', 4096),
+    ('UA_MAX_LENGTH', 512),
+    ('UA_PARSER_WARMUP', False),
+
+    # geoip results cache, keyed by network prefix (like 24 and 48 to share by networks)
+    ('GEOIP_CACHE_SIZE', 10000),
+    ('GEOIP_CACHE_TTL', 60 * 60 * 24),
+    ('GEOIP_CACHE_NEGATIVE_TTL', 60 * 60),
+    ('GEOIP_CACHE_IPV4_PREFIX', 32),
+    ('GEOIP_CACHE_IPV6_PREFIX', 128),
+
+    # (limit, seconds) per email and remote address, checked before schema loading
+    ('THROTTLE_MAX_KEYS', 100000),
+
+    ('LOGIN_THROTTLE_EMAIL', (10, 60)),
+    ('LOGIN_THROTTLE_ADDR', (100, 60)),
+    ('REGISTER_START_THROTTLE_EMAIL', (3, 60 * 10)),
+    ('REGISTER_START_THROTTLE_ADDR', (20, 60 * 10)),
+    ('RESTORE_START_THROTTLE_EMAIL', (3, 60 * 10)),
+    ('RESTORE_START_THROTTLE_ADDR', (20, 60 * 10)),
+
+    # unique user fields, users found by them are loaded once per request
+    ('USER_IDENTITY_FIELDS', ('id', 'email', 'auth_id')),
+    # cache users loaded by auth_id, user_cache argument may set shared backend
+    ('USER_CACHE', False),
+    ('USER_CACHE_SIZE', 10000),
+    ('USER_CACHE_TTL', 60),
+    # fields not stored in user cache, loaded from datastore on access
+    ('USER_CACHE_EXCLUDE', ('password',)),
+    # cache user role names across requests, roles_cache argument may set shared backend
+    ('ROLES_CACHE', False),
+    ('ROLES_CACHE_SIZE', 10000),
+    ('ROLES_CACHE_TTL', 60),
+
+    # cache serialized user of status per auth_id, status_cache argument may set shared backend,
+    # without it user is serialized for status etag on each request, even if it's not modified
+    ('STATUS_CACHE', False),
+    ('STATUS_CACHE_SIZE', 10000),
+    ('STATUS_CACHE_TTL', 60),
+    # dump these schemas with serializer generated from fields at startup,
+    # like ('user_schema', 'provider_user_schema')
+    ('COMPILED_SCHEMAS', ()),
+
+    # insert login tracking rows in background, in bulk
+    ('TRACK_LOGIN_BUFFER', False),
+    ('TRACK_LOGIN_BUFFER_SIZE', 100),
+    ('TRACK_LOGIN_BUFFER_INTERVAL', 5.),
+
+    # max datastore calls per userflow view, logged or raised if exceeded
+    ('QUERY_BUDGET', None),
+    ('QUERY_BUDGET_RAISE', False),
 
     ('AUTHOMATIC_CONFIG', {}),
     ('AUTHOMATIC_SECRET_KEY', LazyValue(lambda c, app_c: c['SECRET_KEY'])),
 
+    # auth token is read from this header if user is not in session
+    ('AUTH_TOKEN_HEADER', 'Authentication-Token'),
+    # "auth_id" token is checked by datastore on each request, "compact" is binary
+    # "auth_id" token for md5 auth_id (~50 chars), "stateless" token carries
+    # AUTH_TOKEN_FIELDS and roles, and is trusted for AUTH_TOKEN_STATELESS_METHODS
+    # requests without datastore query until it's older than AUTH_TOKEN_MAX_STALENESS,
+    # then it's checked by auth_id and refreshed token is sent in AUTH_TOKEN_HEADER
+    ('AUTH_TOKEN_FORMAT', 'auth_id'),
+    ('AUTH_TOKEN_FIELDS', ('name', 'email', 'locale', 'timezone')),
+    ('AUTH_TOKEN_STATELESS_METHODS', ('GET', 'HEAD', 'OPTIONS')),
+    ('AUTH_TOKEN_MAX_STALENESS', 60 * 5),
+    ('AUTH_TOKEN_AGE', 60 * 60 * 24 * 30),
+    # revoke_auth_token support, revoked token ids are kept in Bloom filter per
+    # time bucket and in exact store (revocation_store argument may set shared one,
+    # other workers see revocations after AUTH_TOKEN_REVOCATION_SYNC seconds)
+    ('AUTH_TOKEN_REVOCATION', False),
+    ('AUTH_TOKEN_REVOCATION_BUCKET', 60 * 60 * 24),
+    ('AUTH_TOKEN_REVOCATION_CAPACITY', 100000),
+    ('AUTH_TOKEN_REVOCATION_ERROR_RATE', 0.001),
+    ('AUTH_TOKEN_REVOCATION_SYNC', 10),
+
     ('REGISTER_CONFIRM_URL', '/register_confirm/{}'),
     ('REGISTER_CONFIRM_AGE', 60 * 60 * 24 * 14),
 
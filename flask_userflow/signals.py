@@ -4,3 +4,11 @@ signals = blinker.Namespace()
 
 register_finish = signals.signal("user-register-finish")
 logged_in = signals.signal("user-logged-in")
+
+# sent by datastore with datastore as sender, when user is updated or deleted
+user_changed = signals.signal("user-changed")
+
+# sent by datastore with datastore as sender on each public method call,
+# with method name and duration in seconds (lazy queries returned by
+# SQLAlchemyDatastore find_{model}s are executed after the call and not timed)
+datastore_called = signals.signal("datastore-called")
@@ -0,0 +1,95 @@
+import time
+import threading
+
+
+class MemoryThrottleStore(object):
+    """In-process sliding window counters.
+
+    Sliding window is approximated with current and previous fixed windows,
+    so each key costs one small list regardless of hits count.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._counters = {}  # key: [expires, window index, current, previous]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._counters)
+
+    def hit(self, key, window, now=None):
+        """Registers hit and returns hits count in sliding window"""
+        now = now or time.time()
+        index, elapsed = divmod(now, window)
+
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None or counter[1] < index - 1:
+                counter = [0, index, 0, 0]
+            elif counter[1] == index - 1:
+                counter = [0, index, 0, counter[2]]
+            counter[0] = (index + 2) * window
+            counter[2] += 1
+            self._counters[key] = counter
+
+            if len(self._counters) > self.max_keys:
+                self._prune(now)
+
+        return counter[2] + counter[3] * (1 - elapsed / float(window))
+
+    def _prune(self, now):
+        for key, counter in list(self._counters.items()):
+            if counter[0] < now:
+                del self._counters[key]
+        # fresh keys only, evict arbitrary ones to keep memory bounded
+        while len(self._counters) > self.max_keys * 0.9:
+            self._counters.popitem()
+
+
+class RedisThrottleStore(object):
+    """Shared store for multiple workers, accepts redis client instance"""
+
+    def __init__(self, redis, prefix='userflow:throttle:'):
+        self.redis = redis
+        self.prefix = prefix
+
+    def hit(self, key, window, now=None):
+        now = now or time.time()
+        index, elapsed = divmod(now, window)
+        key = u'{}{}:{}'.format(self.prefix, key, int(window))
+
+        pipe = self.redis.pipeline()
+        pipe.incr(u'{}:{}'.format(key, int(index)))
+        pipe.expire(u'{}:{}'.format(key, int(index)), int(window * 2))
+        pipe.get(u'{}:{}'.format(key, int(index - 1)))
+        current, _, previous = pipe.execute()
+        return current + int(previous or 0) * (1 - elapsed / float(window))
+
+
+class Throttle(object):
+    """Checks {NAME}_THROTTLE_EMAIL and {NAME}_THROTTLE_ADDR (limit, seconds) limits"""
+
+    def __init__(self, config, store=None):
+        self.config = config
+        if store is None:
+            store = MemoryThrottleStore(config['THROTTLE_MAX_KEYS'])
+        self.store = store
+        self.rejected = 0
+
+    def check(self, name, **values):
+        """Returns seconds to retry after if limit exceeded, None otherwise"""
+        for kind, value in sorted(values.items()):
+            limit = self.config.get('{}_THROTTLE_{}'.format(name.upper(), kind.upper()))
+            if not limit or not value:
+                continue
+            limit, window = limit
+            key = u'{}:{}:{}'.format(name, kind, value)
+            if self.store.hit(key, window) > limit:
+                self.rejected += 1
+                return window
+
+    def stats(self):
+        return {
+            'keys': len(self.store) if hasattr(self.store, '__len__') else None,
+            'rejected': self.rejected,
+        }
@@ -1,6 +1,12 @@
 import base64
+import binascii
 import hashlib
 import hmac
+import socket
+from bisect import bisect_right
+from datetime import datetime
+
+import pytz
 
 
 def md5(data):
@@ -18,3 +24,32 @@ def set_attrs_from_dict(obj, dict_, attrs, pop=False):
             setattr(obj, attr, dict_[attr])
             if pop:
                 del dict_[attr]
+
+
+def ip_network_key(address, ipv4_prefix=32, ipv6_prefix=128):
+    """Returns network/prefix for ip address, or address itself for full prefix"""
+    for family, prefix, size in ((socket.AF_INET, ipv4_prefix, 32),
+                                 (socket.AF_INET6, ipv6_prefix, 128)):
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError, TypeError):
+            continue
+        if prefix >= size:
+            return address
+        value = int(binascii.hexlify(packed), 16) >> (size - prefix) << (size - prefix)
+        packed = binascii.unhexlify('%0*x' % (size // 4, value))
+        return '{}/{}'.format(socket.inet_ntop(family, packed), prefix)
+    return address
+
+
+def next_dst_transition(zones, now=None):
+    """Returns nearest future utc transition (naive datetime) among zones or None"""
+    now = now or datetime.utcnow()
+    result = None
+    for zone in zones:
+        transitions = getattr(pytz.timezone(zone), '_utc_transition_times', None)
+        if transitions:
+            i = bisect_right(transitions, now)
+            if i < len(transitions) and (result is None or transitions[i] < result):
+                result = transitions[i]
+    return result
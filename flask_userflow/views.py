@@ -1,13 +1,15 @@
+import json
 from datetime import datetime
 from functools import wraps
 
 from werkzeug.local import LocalProxy
 from flask import (request, Response, after_this_request, make_response, session, redirect,
-                   jsonify, current_app)
+                   jsonify, current_app, g)
 from flask_login import login_user as _login_user, logout_user, current_user, login_required
 from authomatic.adapters import WerkzeugAdapter
 
 from . import _userflow, signals
+from .utils import md5
 
 
 _datastore = LocalProxy(lambda: _userflow.datastore)
@@ -19,6 +21,38 @@ def schema_errors_processor(errors):
     return response
 
 
+def executor_busy_processor(error):
+    response = jsonify({'errors': {'_schema': ['SERVICE_BUSY']}})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def throttled_processor(retry_after):
+    response = jsonify({'errors': {'_schema': ['TOO_MANY_REQUESTS']}})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(retry_after))
+    return response
+
+
+def throttle(name):
+    """Checks limits by payload email and remote address before schema loading"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(payload, *args, **kwargs):
+            email = isinstance(payload, dict) and payload.get('email')
+            if not isinstance(email, basestring):
+                email = None
+            retry_after = _userflow.throttle.check(
+                name, email=email and email.strip().lower(),
+                addr=_userflow.request_utils.get_remote_addr())
+            if retry_after:
+                return _userflow.views['_throttled_processor'](retry_after)
+            return func(payload, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def load_schema(schema_name):
     # using schema_name for lazy getting schema, in case of override
     def decorator(func):
@@ -52,6 +86,11 @@ def response_json(func):
     return wrapper
 
 
+def _commit(response):
+    _datastore.commit()
+    return response
+
+
 def login_user(user, remember=False, provider=None):
     assert user.is_active
     logged_in = _login_user(user, remember)
@@ -66,7 +105,14 @@ def login_user(user, remember=False, provider=None):
     else:
         geoip_info = None
 
-    if _datastore.track_login_model:
+    if _userflow.track_login_buffer is not None:
+        _userflow.track_login_buffer.add(
+            time=datetime.utcnow(),
+            remote_addr=remote_addr,
+            geoip_info=geoip_info,
+            ua_info=ua_info,
+        )
+    elif _datastore.track_login_model:
         track_login = _datastore.create_track_login(
             time=datetime.utcnow(),
             remote_addr=remote_addr,
@@ -74,13 +120,18 @@ def login_user(user, remember=False, provider=None):
             ua_info=ua_info,
         )
         _datastore.put(track_login)
-        after_this_request(lambda r: _datastore.commit())
+        after_this_request(_commit)
 
     signals.logged_in.send(app=current_app._get_current_object(), user=user,
                            remote_addr=remote_addr, geoip_info=geoip_info, ua_info=ua_info)
-    return user.get_auth_token()
+    auth_token = user.get_auth_token()
+    if _userflow.revocations is not None:
+        # session is revoked with token
+        session['auth_token_id'] = _userflow.get_auth_token_id(auth_token)
+    return auth_token
 
 
+@throttle('login')
 @load_schema('login')
 def login(data):
     user, data = data
@@ -92,13 +143,64 @@ def login(data):
 
 def logout():
     logout_user()
+    session.pop('auth_token_id', None)
     return status()
 
 
-def status():
-    if not current_user.is_anonymous:
-        user, errors = _userflow.schemas['user_schema'].dump(current_user)
+def get_user_status(user):
+    """Returns (serialized user, etag of it), once per request,
+    and cached per auth_id if status cache enabled"""
+    request_cache = getattr(g, '_userflow_status', None)
+    if request_cache is None:
+        request_cache = g._userflow_status = {}
+    if user.auth_id in request_cache:
+        return request_cache[user.auth_id]
+
+    cache = _userflow.status_cache
+    cached = cache.get(user.auth_id) if cache is not None else None
+    if cached is None:
+        data, errors = _userflow.schemas['user_schema'].dump(user)
         assert not errors
+        cached = (data, md5(json.dumps(data, sort_keys=True)))
+        if cache is not None:
+            cache.set(user.auth_id, cached)
+    request_cache[user.auth_id] = cached
+    return cached
+
+
+def get_auth_provider():
+    """Returns {provider: serialized provider user} for providers in session,
+    not found ones are removed from session"""
+    auth_provider = {}
+    if 'auth_provider' not in session:
+        return auth_provider
+    for provider, provider_user_id in session['auth_provider'].items():
+        provider_user = _datastore.find_provider_user(provider=provider,
+                                                      provider_user_id=provider_user_id)
+        if provider_user:
+            schema = _userflow.schemas['provider_user_schema']
+            auth_provider[provider] = schema.dump(provider_user).data
+        else:
+            session['auth_provider'].pop(provider)
+    if not session['auth_provider']:
+        session.pop('auth_provider')
+    return auth_provider
+
+
+def get_status_etag(auth_provider):
+    """Returns status etag, user is serialized once per request for both etag
+    and response, or is not serialized at all if it's in status cache"""
+    parts = [current_user.locale, current_user.timezone, auth_provider]
+    if not current_user.is_anonymous:
+        parts.extend([current_user.auth_id, get_user_status(current_user)[1]])
+    if _userflow.request_utils.geoip:
+        parts.append(_userflow.request_utils.get_remote_addr())
+    return md5(json.dumps(parts, sort_keys=True))
+
+
+def status(auth_provider=None):
+    if not current_user.is_anonymous:
+        user = get_user_status(current_user)[0]
     else:
         user = None
 
@@ -108,20 +210,10 @@ def status():
         'timezone': current_user.timezone,
     }
 
-    if 'auth_provider' in session:
-        auth_provider = {}
-        for provider, provider_user_id in session['auth_provider'].items():
-            provider_user = _datastore.find_provider_user(provider=provider,
-                                                          provider_user_id=provider_user_id)
-            if provider_user:
-                schema = _userflow.schemas['ProviderUserSchema']
-                auth_provider[provider] = schema.dump(provider_user)
-            else:
-                session['auth_provider'].pop(provider)
-        if not session['auth_provider']:
-            session.pop('auth_provider')
-        if auth_provider:
-            result['auth_provider'] = auth_provider
+    if auth_provider is None:
+        auth_provider = get_auth_provider()
+    if auth_provider:
+        result['auth_provider'] = auth_provider
 
     if _userflow.request_utils.geoip:
         result['geoip'] = _userflow.request_utils.get_geoip_info()
@@ -129,6 +221,21 @@ def status():
     return result
 
 
+def status_view():
+    """Status with conditional GET support"""
+    # stale providers are removed before etag is calculated, so it matches response
+    auth_provider = get_auth_provider()
+    etag = get_status_etag(auth_provider)
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(status(auth_provider))
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
 @load_schema('set_i18n')
 def set_i18n(data):
     if 'timezone' in data:
@@ -137,10 +244,20 @@ def set_i18n(data):
         current_user.locale = data['locale']
     if not current_user.is_anonymous:
         _datastore.commit()
+        _userflow.invalidate_status(current_user.auth_id)
 
 
 def timezones():
-    return {'timezones': _userflow.get_timezone_choices()}
+    choices = _userflow.timezone_choices(current_user.locale)
+    if choices['etag'] in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify({'timezones': choices['choices']})
+    response.set_etag(choices['etag'])
+    response.expires = choices['expires']
+    response.cache_control.max_age = \
+        int((choices['expires'] - datetime.utcnow()).total_seconds())
+    return response
 
 
 def provider_login(provider, goal):
@@ -168,21 +285,21 @@ def provider_login(provider, goal):
             provider_user.set_provider_data(result.user)
             _datastore.put(provider_user)
 
-        after_this_request(lambda r: _datastore.commit())
+        after_this_request(_commit)
 
         if goal == 'ASSOCIATE':
             provider_user.user_id == current_user.id
             return redirect(_userflow.config['PROVIDER_ASSOCIATE_SUCCEED_URL'])
 
         if provider_user.user_id:
-            user = _datastore.find_user(id=provider_user.user_id)
+            user = _userflow.get_user(id=provider_user.user_id)
             if not user.is_active:
                 return redirect(_userflow.config['PROVIDER_LOGIN_INACTIVE_URL'])
             login_user(user, False, provider)
             return redirect(_userflow.config['PROVIDER_LOGIN_SUCCEED_URL'])
 
         if result.user.email:
-            user = _datastore.find_user(email=result.user.email)
+            user = _userflow.get_user(email=result.user.email)
             if user:
                 provider_user.user_id = user.id
                 if not user.is_active:
@@ -206,12 +323,13 @@ def provider_login(provider, goal):
             return redirect(_userflow.config['REGISTER_START_URL'])
 
 
+@throttle('register_start')
 @load_schema('register_start')
 def register_start(data):
     token = _userflow.register_confirm_serializer.dumps(data['email'])
     confirm_url = _userflow.config['REGISTER_CONFIRM_URL'].format(token)
     _userflow.emails.send('register_start', data['email'],
-                          {'confirm_url': confirm_url, 'token': token})
+                          {'confirm_url': confirm_url, 'token': token}, current_user.locale)
 
 
 @load_schema('register_confirm')
@@ -257,12 +375,13 @@ def register_finish(data, login=True, login_remember=False):
     return data
 
 
+@throttle('restore_start')
 @load_schema('restore_start')
 def restore_start(data):
     token = _userflow.restore_confirm_serializer.dumps(data['email'])
     confirm_url = _userflow.config['RESTORE_CONFIRM_URL'].format(token)
     _userflow.emails.send('restore_start', data['email'],
-                          {'confirm_url': confirm_url, 'token': token})
+                          {'confirm_url': confirm_url, 'token': token}, current_user.locale)
 
 
 @load_schema('restore_confirm')
@@ -291,15 +410,18 @@ def restore_finish(data, login=True, login_remember=False):
 def password_change(data):
     current_user.set_password(data['password'])
     _datastore.commit()
+    _userflow.invalidate_status(current_user.auth_id)
     return status()
 
 
 views_map = {
     '_schema_errors_processor': schema_errors_processor,
+    '_executor_busy_processor': executor_busy_processor,
+    '_throttled_processor': throttled_processor,
 
     'login': login,
     'logout': logout,
-    'status': status,
+    'status': status_view,
     'set_i18n': set_i18n,
     'timezones': timezones,
 
@@ -0,0 +1,103 @@
+import os
+import time
+import atexit
+import threading
+
+from flask import current_app
+
+
+class WriteBuffer(object):
+    """Write-behind buffer for insert-only rows, like login tracking.
+
+    Rows are appended in memory and inserted by background thread with
+    datastore.bulk_insert when size rows are buffered, every interval
+    seconds and on interpreter shutdown.
+    """
+
+    def __init__(self, datastore, model, size=100, interval=5.):
+        self.datastore = datastore
+        self.model = model
+        self.size = size
+        self.interval = interval
+
+        self._rows = []
+        self._app = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+        self.flushed = 0
+        self.failed = 0
+        self.flushes = 0
+        self.flush_time = 0.
+        self.max_flush_time = 0.
+
+    def add(self, **row):
+        self._start()
+        with self._lock:
+            self._rows.append(row)
+            full = len(self._rows) >= self.size
+        if full:
+            self._wakeup.set()
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._app = current_app._get_current_object()
+                self._rows = []
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+                if self._pid is None:
+                    atexit.register(self.flush)
+                self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Inserts buffered rows, returns inserted rows count"""
+        if self._app is None:
+            return 0
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return 0
+
+            started = time.time()
+            with self._app.app_context():
+                try:
+                    self.datastore.bulk_insert(self.model, rows)
+                except Exception:
+                    self.failed += len(rows)
+                    self._app.logger.exception('Bulk insert of %s %s rows failed',
+                                               len(rows), self.model.__name__)
+                    return 0
+            spent = time.time() - started
+
+            self.flushed += len(rows)
+            self.flushes += 1
+            self.flush_time += spent
+            self.max_flush_time = max(self.max_flush_time, spent)
+            return len(rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def stats(self):
+        return {
+            'buffered': len(self),
+            'flushed': self.flushed,
+            'failed': self.failed,
+            'flushes': self.flushes,
+            'avg_flush_time': self.flushes and self.flush_time / self.flushes,
+            'max_flush_time': self.max_flush_time,
+        }
@@ -4,8 +4,8 @@ import os
 import pytest
 from flask import Flask
 
-from flask_userflow import Userflow, SQLAlchemyDatastore, UserMixin
-from utils import Response, TestClient, populate_datastore
+from flask_userflow import SQLAlchemyDatastore, MemoryDatastore, UserMixin
+from utils import Response, TestClient, MemoryModel, MemoryUser, init_userflow
 
 
 @pytest.fixture()
@@ -46,22 +46,70 @@ def sqlalchemy_datastore(request, tmpdir, app):
         locale = db.Column(db.String(255))
         timezone = db.Column(db.String(255))
 
+    class Role(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        user_id = db.Column(db.Integer, db.ForeignKey(User.id))
+        name = db.Column(db.String(255))
+
+    class TrackLogin(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        time = db.Column(db.DateTime)
+        remote_addr = db.Column(db.String(255))
+        geoip_info = db.Column(db.PickleType)
+        ua_info = db.Column(db.PickleType)
+
     with app.app_context():
         db.create_all()
 
     request.addfinalizer(lambda: os.remove(path))
 
-    return SQLAlchemyDatastore(db, User)
+    return SQLAlchemyDatastore(db, User, role_model=Role, track_login_model=TrackLogin)
+
+
+@pytest.fixture()
+def memory_datastore():
+    class User(MemoryUser):
+        pass
+
+    class Role(MemoryModel):
+        user_id = name = None
+
+    class TrackLogin(MemoryModel):
+        time = remote_addr = geoip_info = ua_info = None
+
+    return MemoryDatastore(User, role_model=Role, track_login_model=TrackLogin)
+
+
+@pytest.fixture(params=['sqlalchemy', 'memory'])
+def datastore(request):
+    return request.getfixturevalue('{}_datastore'.format(request.param))
 
 
 @pytest.fixture()
 def sqlalchemy_app(app, sqlalchemy_datastore):
-    app.userflow = Userflow(app, datastore=sqlalchemy_datastore)
-    with app.app_context():
-        populate_datastore(app.userflow)
-    return app
+    return init_userflow(app, sqlalchemy_datastore)
+
+
+@pytest.fixture()
+def userflow_app(app, datastore):
+    return init_userflow(app, datastore)
+
+
+@pytest.fixture()
+def client(request, userflow_app):
+    return userflow_app.test_client()
 
 
 @pytest.fixture()
-def client(request, sqlalchemy_app):
-    return sqlalchemy_app.test_client()
+def create_client(app, datastore):
+    """Creates client with USERFLOW_ config overrides (uppercase keys)
+    and extension arguments (lowercase keys)"""
+    def create_client(**config):
+        kwargs = {}
+        for key, value in config.items():
+            if key.isupper():
+                app.config['USERFLOW_' + key] = value
+            else:
+                kwargs[key] = value
+        return init_userflow(app, datastore, **kwargs).test_client()
+    return create_client
@@ -0,0 +1,173 @@
+import pytest
+
+from flask_userflow import signals
+from flask_userflow.datastore import QueryBudgetExceeded, get_query_stats
+
+
+def test_bulk_operations(userflow_app, datastore):
+    with userflow_app.app_context():
+        emails = ['user{}@lp.com'.format(i) for i in range(7)]
+        datastore.chunk_size = 3
+        datastore.bulk_create_users([{'email': email, 'is_active': True} for email in emails])
+        datastore.commit()
+
+        users = sorted(datastore.find_users_by('email', emails + emails[:2]),
+                       key=lambda user: user.email)
+        assert [user.email for user in users] == emails
+
+        datastore.bulk_update_users([{'id': user.id, 'is_active': False} for user in users[:4]])
+        datastore.commit()
+        assert len(list(datastore.find_users(is_active=False))) == 4
+
+        datastore.delete_all(users[:5])
+        datastore.commit()
+        assert sorted(user.email for user in datastore.find_users_by('email', emails)) == \
+            emails[5:]
+
+        user = datastore.create_user(email='new@lp.com')
+        datastore.put_all([user])
+        datastore.commit()
+        assert datastore.find_users_by('email', ['new@lp.com']) == [user]
+
+
+def test_find_models_stats(userflow_app, datastore):
+
+    with userflow_app.app_context():
+        assert len(list(datastore.find_users(email='vgavro@gmail.com'))) == 1
+        assert get_query_stats()['methods']['find_users'][0] == 1
+
+
+def test_bulk_update_invalidates_user_cache(create_client):
+    client = create_client(USER_CACHE=True)
+    userflow = client.application.userflow
+    resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                             'password': 'password'})
+    assert resp.status_code == 200
+    assert client.get('/user/status').json['user']
+
+    with client.application.app_context():
+        user = userflow.datastore.find_user(email='vgavro@gmail.com')
+        userflow.datastore.bulk_update_users([{'id': user.id, 'name': 'Changed'}])
+        userflow.datastore.commit()
+    assert client.get('/user/status').json['user']['name'] == 'Changed'
+
+
+def test_memory_datastore_transactions(app, memory_datastore):
+    datastore = memory_datastore
+    with app.app_context():
+        user = datastore.create_user(email='matt@lp.com', auth_id='a')
+        datastore.put(user)
+        datastore.commit()
+        assert user.id == 1
+        assert datastore.find_user(email='matt@lp.com') is user
+
+        user.email = 'john@lp.com'
+        new_user = datastore.create_user(email='new@lp.com')
+        datastore.put(new_user)
+        # query flushes changes and updates indexes
+        assert datastore.find_user(email='john@lp.com') is user
+        assert datastore.find_user(email='matt@lp.com') is None
+        assert datastore.find_user(email='new@lp.com') is new_user
+
+        datastore.rollback()
+        assert user.email == 'matt@lp.com'
+        assert datastore.find_user(email='matt@lp.com') is user
+        assert datastore.find_user(email='new@lp.com') is None
+
+        datastore.delete(user)
+        datastore.commit()
+        assert datastore.find_user(auth_id='a') is None
+
+    with app.app_context():
+        # objects are loaded once per app context
+        user = datastore.create_user(email='matt@lp.com')
+        datastore.put(user)
+        datastore.commit()
+    with app.app_context():
+        found = datastore.find_user(email='matt@lp.com')
+        assert found is not user
+        assert found.id == user.id
+        assert found is datastore.find_user(id=user.id)
+
+
+def test_memory_datastore_indexes(app, memory_datastore):
+    datastore = memory_datastore
+    with app.app_context():
+        datastore.bulk_create_roles([{'user_id': i % 3, 'name': 'role'} for i in range(9)])
+        datastore.commit()
+        index = datastore._indexes[datastore.role_model][('user_id',)]
+        assert sorted(index[(1,)]) == [2, 5, 8]
+        assert [role.id for role in datastore.find_roles(user_id=1, name='role')] == [2, 5, 8]
+        assert sorted(datastore.find_roles_for_users([0, 4])[0], key=lambda r: r.id) == \
+            datastore.find_roles(user_id=0)
+
+
+def test_memory_datastore_concurrent_sessions(app, memory_datastore):
+    datastore = memory_datastore
+    with app.app_context():
+        datastore.put(datastore.create_user(email='matt@lp.com', name='Matt'))
+        datastore.commit()
+
+    with app.app_context():
+        user = datastore.find_user(email='matt@lp.com')
+        with app.app_context():
+            other = datastore.find_user(email='matt@lp.com')
+            assert other is not user
+            other.password = 'changed'
+            datastore.commit()
+        user.name = 'John'
+        datastore.commit()
+
+    with app.app_context():
+        user = datastore.find_user(email='matt@lp.com')
+        # unchanged fields of other session are not overwritten
+        assert (user.name, user.password) == ('John', 'changed')
+
+
+def test_query_budget(create_client):
+    client = create_client(QUERY_BUDGET=1, QUERY_BUDGET_RAISE=True)
+    calls = []
+
+    def on_called(datastore, method, duration):
+        calls.append(method)
+    signals.datastore_called.connect(on_called)
+    try:
+        with pytest.raises(QueryBudgetExceeded) as excinfo:
+            client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                              'password': 'password'})
+    finally:
+        signals.datastore_called.disconnect(on_called)
+
+    # user is found once per request, track login is put and committed
+    assert calls == ['find_user', 'put', 'commit']
+    assert 'find_user: 1' in str(excinfo.value)
+    assert client.get('/user/status').status_code == 200
+
+
+def test_user_identity_map(userflow_app):
+    userflow = userflow_app.userflow
+    calls = []
+
+    def on_called(datastore, method, duration):
+        calls.append(method)
+    signals.datastore_called.connect(on_called)
+    try:
+        with userflow_app.test_request_context():
+            user = userflow.get_user(email='vgavro@gmail.com')
+            assert userflow.get_user(email='vgavro@gmail.com') is user
+            assert userflow.get_user(auth_id=user.auth_id) is user
+            assert userflow.get_user(id=user.id) is user
+            assert calls == ['find_user']
+
+            # not found users are not remembered
+            assert userflow.get_user(email='matt@lp.com') is None
+            assert userflow.get_user(email='matt@lp.com') is None
+            assert calls == ['find_user'] * 3
+
+            old_auth_id = user.auth_id
+            user.generate_auth_id()
+            userflow.datastore.commit()
+            assert userflow.get_user(auth_id=old_auth_id) is None
+            assert userflow.get_user(auth_id=user.auth_id) is user
+    finally:
+        signals.datastore_called.disconnect(on_called)
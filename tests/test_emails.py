@@ -0,0 +1,255 @@
+import os
+import time
+import asyncore
+import smtpd
+import subprocess
+import threading
+
+import pytest
+from jinja2 import DictLoader
+
+from flask_userflow.outbox import MemoryOutboxStore
+
+
+class SMTPChannel(smtpd.SMTPChannel):
+    def __init__(self, server, conn, addr):
+        self.smtp_server = server
+        smtpd.SMTPChannel.__init__(self, server, conn, addr)
+
+    def add_channel(self, map=None):
+        # register in server socket map instead of global one
+        self._map = self.smtp_server.map
+        asyncore.dispatcher.add_channel(self, self._map)
+
+
+class SMTPServer(smtpd.SMTPServer):
+    """Local SMTP stand-in, fails first fail_count messages with temporary error.
+    Uses own socket map, so loops of different servers do not share sockets"""
+
+    def __init__(self, fail_count=0):
+        self.map = {}
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.fail_count = fail_count
+        self.connections = 0
+        self.messages = []
+
+    def add_channel(self, map=None):
+        self._map = self.map
+        asyncore.dispatcher.add_channel(self, self.map)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.connections += 1
+            SMTPChannel(self, *pair)
+
+    def stop(self):
+        for dispatcher in list(self.map.values()):
+            dispatcher.close()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.fail_count:
+            self.fail_count -= 1
+            return '451 Try again later'
+        self.messages.append((rcpttos, data))
+
+
+@pytest.fixture()
+def smtp_server(request):
+    server = SMTPServer()
+    # loop exits when server map is empty
+    thread = threading.Thread(target=asyncore.loop,
+                              kwargs={'timeout': 0.05, 'map': server.map})
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        server.stop()
+        thread.join(1)
+        assert not thread.is_alive()
+    request.addfinalizer(stop)
+    return server
+
+
+@pytest.fixture()
+def smtp_app(app, smtp_server):
+    app.config['EMAIL_BACKEND'] = 'emails.backend.smtp.SMTPBackend'
+    app.config['EMAIL_HOST'] = '127.0.0.1'
+    app.config['EMAIL_PORT'] = smtp_server.port
+    return app
+
+
+def test_email_queue(smtp_app, smtp_server, create_client):
+    smtp_server.fail_count = 1
+    client = create_client(EMAIL_QUEUE=True, EMAIL_QUEUE_BACKOFF=0.01)
+    queue = client.application.userflow.emails.queue
+
+    emails = ['matt{}@lp.com'.format(i) for i in range(3)]
+    for email in emails:
+        resp = client.post('/user/register', json={'email': email})
+        assert resp.status_code == 200
+    queue.join()
+
+    assert sorted(m[0][0] for m in smtp_server.messages) == emails
+    assert 'Subject: Registration' in smtp_server.messages[0][1]
+    stats = client.application.userflow.stats()['email_queue']
+    assert stats['sent'] == 3
+    assert stats['failed'] == 0
+    # one reconnect after failure
+    assert smtp_server.connections == stats['connections'] == 2
+
+    queue.stop()
+    assert not any(thread.is_alive() for thread in queue._threads)
+
+
+def test_email_queue_retry_not_blocking(smtp_app, smtp_server, create_client):
+    smtp_server.fail_count = 1
+    client = create_client(EMAIL_QUEUE=True, EMAIL_QUEUE_WORKERS=1, EMAIL_QUEUE_BACKOFF=60)
+    queue = client.application.userflow.emails.queue
+
+    for email in ('matt@lp.com', 'john@lp.com', 'mark@lp.com'):
+        client.post('/user/register', json={'email': email})
+    # failed message waits for retry, others are delivered meanwhile
+    for _ in range(40):
+        if len(smtp_server.messages) == 2:
+            break
+        time.sleep(0.05)
+    assert sorted(m[0][0] for m in smtp_server.messages) == ['john@lp.com', 'mark@lp.com']
+
+    started = time.time()
+    queue.stop()
+    assert time.time() - started < 5
+    assert queue.stats()['failed'] == 1
+    assert queue._queue.unfinished_tasks == 0
+
+
+def test_email_templates_locale(app, create_client):
+    app.jinja_loader = DictLoader({
+        'userflow/emails/ru/register_start_subject.txt': u'\u0420\u0435\u0433',
+        'userflow/emails/ru/register_start.html': u'{{ confirm_url }}',
+    })
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    client = create_client()
+    emails = client.application.userflow.emails
+
+    with app.app_context():
+        message = emails.create('register_start', {'confirm_url': 'http://confirm'}, 'ru')
+        assert message.subject == u'\u0420\u0435\u0433'
+        assert message.html == 'http://confirm'
+        # fallback to default templates
+        message = emails.create('register_start', {'confirm_url': 'http://confirm'}, 'en')
+        assert message.subject == 'Registration'
+        assert emails.get_templates('register_start', 'ru') is \
+            emails.get_templates('register_start', 'ru')
+
+
+def generate_dkim_key():
+    # openssl 3 generates PKCS#8 keys without -traditional
+    for args in (['-traditional'], []):
+        try:
+            return subprocess.check_output(['openssl', 'genrsa'] + args + ['1024'],
+                                           stderr=open(os.devnull, 'w'))
+        except subprocess.CalledProcessError:
+            pass
+        except OSError:
+            break
+    pytest.skip('no openssl')
+
+
+def test_email_dkim(app, create_client):
+    key = generate_dkim_key()
+    app.config['EMAIL_DKIM_KEY'] = key
+    app.config['EMAIL_DKIM_DOMAIN'] = 'test'
+    app.config['EMAIL_DKIM_SELECTOR'] = '_dkim'
+    client = create_client()
+    emails = client.application.userflow.emails
+
+    with app.app_context():
+        message = emails.create('register_start', {'confirm_url': 'http://confirm'}, None)
+        assert message._signer is emails.dkim_signer
+        message.set_mail_to('matt@lp.com')
+        assert 'DKIM-Signature' in message.as_string()
+
+
+def test_email_celery_batch(smtp_app, smtp_server, create_client):
+    celery = pytest.importorskip('celery')
+    celery = celery.Celery('test', set_as_current=False)
+    celery.conf.task_always_eager = True
+
+    smtp_server.fail_count = 1
+    client = create_client(celery=celery, EMAIL_CELERY_BATCH=True,
+                           EMAIL_CELERY_BATCH_SIZE=2, EMAIL_QUEUE_BACKOFF=0.01)
+    batcher = client.application.userflow.emails.queue
+
+    emails = ['matt{}@lp.com'.format(i) for i in range(3)]
+    for email in emails:
+        resp = client.post('/user/register', json={'email': email})
+        assert resp.status_code == 200
+    # first batch is dispatched by size, last one is buffered
+    assert len(batcher) == 1
+    batcher.flush()
+
+    assert sorted(m[0][0] for m in smtp_server.messages) == emails
+    stats = client.application.userflow.stats()['email_queue']
+    assert stats == {'buffered': 0, 'messages': 3, 'tasks': 2}
+    # connection per batch, reconnect after failure and one for retry task
+    assert smtp_server.connections == 4
+
+
+def test_email_celery_batch_delay(smtp_app, smtp_server, create_client):
+    celery = pytest.importorskip('celery')
+    celery = celery.Celery('test', set_as_current=False)
+    celery.conf.task_always_eager = True
+
+    client = create_client(celery=celery, EMAIL_CELERY_BATCH=True,
+                           EMAIL_CELERY_BATCH_DELAY=0.05)
+    resp = client.post('/user/register', json={'email': 'matt@lp.com'})
+    assert resp.status_code == 200
+    for _ in range(40):
+        if smtp_server.messages:
+            break
+        time.sleep(0.05)
+    assert [m[0] for m in smtp_server.messages] == [['matt@lp.com']]
+
+
+def test_email_outbox(smtp_app, smtp_server, create_client):
+    client = create_client(EMAIL_OUTBOX_WINDOW=60)
+    for email in ('matt@lp.com', 'Matt@lp.com', 'john@lp.com'):
+        resp = client.post('/user/register', json={'email': email})
+        assert resp.status_code == 200
+    for _ in range(2):
+        resp = client.post('/user/restore', json={'email': 'vgavro@gmail.com'})
+        assert resp.status_code == 200
+
+    assert [m[0][0] for m in smtp_server.messages] == \
+        ['matt@lp.com', 'john@lp.com', 'vgavro@gmail.com']
+    assert client.application.userflow.stats()['email_outbox'] == \
+        {'keys': 3, 'suppressed': 2}
+
+
+def test_email_outbox_failed(smtp_app, smtp_server, create_client):
+    port = smtp_app.config['EMAIL_PORT']
+    smtp_app.config['EMAIL_PORT'] = 1
+    client = create_client(EMAIL_OUTBOX_WINDOW=60)
+    resp = client.post('/user/register', json={'email': 'matt@lp.com'})
+    assert resp.status_code == 200
+    assert not smtp_server.messages
+
+    # failed email is not counted as sent
+    client.application.extensions['emails'].smtp_options['port'] = port
+    resp = client.post('/user/register', json={'email': 'matt@lp.com'})
+    assert resp.status_code == 200
+    assert [m[0] for m in smtp_server.messages] == [['matt@lp.com']]
+    assert client.application.userflow.stats()['email_outbox']['suppressed'] == 0
+
+
+def test_outbox_store_expiry():
+    store = MemoryOutboxStore(max_keys=2)
+    assert store.add('a', 10, now=100)
+    assert not store.add('a', 10, now=109)
+    assert store.add('a', 10, now=111)
+    assert store.add('b', 10, now=111)
+    # expired keys are pruned on overflow
+    assert store.add('c', 10, now=125)
+    assert len(store) == 1
@@ -0,0 +1,78 @@
+import pytest
+
+from flask_userflow.settings import Config
+from flask_userflow.hashers import PasswordHashers, ScryptHasher
+
+
+@pytest.fixture()
+def hashers():
+    return PasswordHashers(Config({
+        'SECRET_KEY': 'secret',
+        'USERFLOW_PASSWORD_ROUNDS': 4,
+        'USERFLOW_PASSWORD_PBKDF2_ROUNDS': 1000,
+        'USERFLOW_PASSWORD_SCRYPT_N': 2 ** 10,
+    }))
+
+
+@pytest.mark.parametrize('name', ['bcrypt', 'pbkdf2_sha256', 'scrypt'])
+def test_hasher(hashers, name):
+    hasher = hashers.get(name)
+    if not hasher:
+        assert not ScryptHasher.available
+        pytest.skip('{} is not available'.format(name))
+
+    password_hash = hasher.encrypt(u'password')
+    assert hashers.identify(password_hash) is hasher
+    assert hasher.verify(u'password', password_hash)
+    assert not hasher.verify(u'wrong password', password_hash)
+    assert not hasher.needs_rehash(password_hash)
+
+
+@pytest.mark.parametrize('password_hash', [
+    '$2b$xx$invalid', '$pbkdf2-sha256$1000$x', '$pbkdf2-sha256$x$AAAA$AAAA',
+    '$pbkdf2-sha256$1000$A$AAAA', '$scrypt$ln=x$AAAA$AAAA', '$scrypt$r=8$AAAA$AAAA',
+])
+def test_malformed_hash(hashers, password_hash):
+    hasher = hashers.identify(password_hash)
+    if hasher is None:
+        pytest.skip('Hasher is not available')
+    assert not hasher.verify(u'password', password_hash)
+    assert hasher.needs_rehash(password_hash)
+
+
+def test_needs_rehash(hashers):
+    bcrypt_hash = hashers.get('bcrypt').encrypt('password')
+    pbkdf2_hash = hashers.get('pbkdf2_sha256').encrypt('password')
+    assert not hashers.needs_rehash(bcrypt_hash)
+    assert hashers.needs_rehash(pbkdf2_hash)
+
+    hashers.default = hashers.get('pbkdf2_sha256')
+    assert hashers.needs_rehash(bcrypt_hash)
+    assert not hashers.needs_rehash(pbkdf2_hash)
+
+    hashers.config['PASSWORD_PBKDF2_ROUNDS'] = 2000
+    assert hashers.needs_rehash(pbkdf2_hash)
+
+
+def test_needs_rehash_rounds(hashers):
+    hasher = hashers.get('bcrypt')
+    password_hash = hasher.encrypt('password')
+    hashers.config['PASSWORD_ROUNDS'] = 5
+    assert hasher.needs_rehash(password_hash)
+
+    # hashes with more rounds within PASSWORD_REHASH_TOLERANCE are kept
+    password_hash = hasher.encrypt('password')
+    hashers.config['PASSWORD_ROUNDS'] = 4
+    assert not hasher.needs_rehash(password_hash)
+    hashers.config['PASSWORD_REHASH_TOLERANCE'] = 0
+    assert hasher.needs_rehash(password_hash)
+    hashers.config['PASSWORD_REHASH_TOLERANCE'] = 1
+    hashers.config['PASSWORD_ROUNDS'] = 3
+    assert hasher.needs_rehash(password_hash)
+
+
+def test_benchmark(hashers):
+    result = hashers.benchmark(duration=0.01)
+    assert set(result) == {h.name for h in hashers.hashers}
+    assert all(r['hashes_per_sec'] > 0 for r in result.values())
+    assert result['bcrypt']['memory']
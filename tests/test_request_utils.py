@@ -0,0 +1,37 @@
+from flask_userflow.settings import Config
+from flask_userflow.request_utils import RequestUtils, AddressNotFoundError
+from flask_userflow.utils import ip_network_key
+
+
+def test_geoip_cache(app):
+    class GeoIP(object):
+        calls = []
+
+        def city(self, address):
+            self.calls.append(address)
+            if address.startswith('10.'):
+                raise AddressNotFoundError()
+            location = type('Location', (), {'latitude': 1., 'longitude': 2.,
+                                             'time_zone': 'Europe/Kiev'})
+            return type('City', (), {'country': type('Country', (), {'iso_code': 'UA'}),
+                                     'city': type('Name', (), {'name': 'Kiev'}),
+                                     'location': location})
+
+    app.config['USERFLOW_GEOIP_CACHE_IPV4_PREFIX'] = 24
+    geoip = GeoIP()
+    request_utils = RequestUtils(Config(app.config), geoip)
+
+    for address in ('1.2.3.4', '1.2.3.5', '10.0.0.1', '10.0.0.2', '1.2.4.1'):
+        with app.test_request_context(environ_base={'REMOTE_ADDR': address}):
+            geoip_info = request_utils.get_geoip_info()
+            assert request_utils.get_geoip_info() is geoip_info
+            assert geoip_info['timezone'] == (None if address.startswith('10.')
+                                              else 'Europe/Kiev')
+    assert geoip.calls == ['1.2.3.4', '10.0.0.1', '1.2.4.1']
+
+
+def test_ip_network_key():
+    assert ip_network_key('1.2.3.4') == '1.2.3.4'
+    assert ip_network_key('1.2.3.4', 24) == '1.2.3.0/24'
+    assert ip_network_key('2001:db8:1:2::1', ipv6_prefix=48) == '2001:db8:1::/48'
+    assert ip_network_key('unknown', 24) == 'unknown'
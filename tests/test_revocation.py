@@ -0,0 +1,65 @@
+import time
+
+from flask_userflow.revocation import BloomFilter, RevocationSet, MemoryRevocationStore
+
+
+def create_revocations(store=None, **config):
+    config = dict({
+        'AUTH_TOKEN_REVOCATION_BUCKET': 60,
+        'AUTH_TOKEN_REVOCATION_CAPACITY': 1000,
+        'AUTH_TOKEN_REVOCATION_ERROR_RATE': 0.01,
+        'AUTH_TOKEN_REVOCATION_SYNC': 10,
+    }, **config)
+    return RevocationSet(config, store)
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add(bloom.positions(str(i)))
+    assert all(bloom.positions(str(i)) in bloom for i in range(1000))
+    false_positives = sum(bloom.positions('x{}'.format(i)) in bloom for i in range(10000))
+    assert false_positives < 10000 * 0.02
+    assert bloom.memory < 1300
+
+
+def test_revocation_set():
+    revocations = create_revocations()
+    now = time.time()
+    for i in range(100):
+        revocations.add('token{}'.format(i), now + 600)
+    revocations.add('expired', now - 120)
+
+    assert 'token1' in revocations
+    assert 'token100' not in revocations
+    assert 'expired' not in revocations
+    # exact store is not checked for most of not revoked ids
+    for i in range(1000):
+        assert 'other{}'.format(i) not in revocations
+    stats = revocations.stats()
+    assert stats['store_checks'] < 30
+    assert stats['revoked'] == 1
+
+    revocations._expire(now + 60 * 12)
+    assert revocations.stats()['buckets'] == 0
+
+
+def test_revocation_set_shared_store():
+    store = MemoryRevocationStore()
+    worker1 = create_revocations(store)
+    worker2 = create_revocations(store)
+    assert 'token1' not in worker2
+
+    worker1.add('token1', time.time() + 600)
+    assert 'token1' in worker1
+    # started after revocation
+    worker3 = create_revocations(store)
+    assert 'token1' in worker3
+
+    # other workers see revocation after sync interval
+    worker2._synced -= 10
+    assert 'token1' in worker2
+    # even if not synced for a long time
+    worker1.add('token2', time.time() + 600)
+    worker2._synced -= 60 * 60 * 24
+    assert 'token2' in worker2
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import pytest
+import marshmallow as ma
+
+from flask_userflow.schemas import CompiledSchema, UserSchema, ProviderUserSchema
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class MixedSchema(ma.Schema):
+    name = ma.fields.Str()
+    email = ma.fields.Email()
+    count = ma.fields.Int()
+    count_str = ma.fields.Int(attribute='count', as_string=True)
+    active = ma.fields.Boolean()
+    renamed = ma.fields.Str(attribute='name', dump_to='title')
+    fallback = ma.fields.Str(default='default')
+    factory = ma.fields.Int(default=lambda: 42)
+    secret = ma.fields.Str(load_only=True)
+    nested = ma.fields.Str(attribute='parent.name')
+    created = ma.fields.DateTime()
+
+
+@pytest.mark.parametrize('obj', [
+    Obj(),
+    Obj(name=None, count=None, active=None, fallback=None, factory=None),
+    Obj(name=u'Имя', email='user@mail.ru', count=3, active='false', secret='x',
+        fallback=1, factory='7', parent=Obj(name=b'parent')),
+    Obj(name=b'\xd0\x98\xd0\xbc\xd1\x8f', count='5', active=1, parent=None),
+])
+def test_compiled_schema_parity(obj):
+    schema = MixedSchema()
+    compiled = CompiledSchema(schema)
+    assert compiled.dump(obj) == schema.dump(obj)
+    assert compiled.dump([obj, obj], many=True) == schema.dump([obj, obj], many=True)
+
+
+def test_compiled_schema_not_compilable():
+    class ProcessedSchema(UserSchema):
+        @ma.post_dump
+        def process(self, data):
+            return data
+
+    with pytest.raises(ValueError):
+        CompiledSchema(ProcessedSchema())
+    with pytest.raises(ValueError):
+        CompiledSchema(UserSchema(many=True))
+
+
+def test_compiled_schema_raises():
+    schema = MixedSchema()
+    assert schema.dump(Obj(email='invalid')).errors
+    with pytest.raises(ma.ValidationError):
+        CompiledSchema(schema).dump(Obj(email='invalid'))
+
+
+def test_compiled_schema_user_parity(userflow_app):
+    with userflow_app.app_context():
+        users = userflow_app.userflow.datastore.find_users_by(
+            'email', ['vgavro@gmail.com'])
+        users.append(Obj(id=None, email=u'имя@mail.ru', name=u'Имя'))
+        for schema in (UserSchema(), ProviderUserSchema()):
+            compiled = CompiledSchema(schema)
+            for user in users + [Obj(provider='google', provider_user_id=123)]:
+                assert compiled.dump(user) == schema.dump(user)
+
+
+def test_compiled_schemas_status(create_client):
+    client = create_client(COMPILED_SCHEMAS=('user_schema', 'provider_user_schema'))
+    assert isinstance(client.application.userflow.schemas['user_schema'], CompiledSchema)
+    resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                             'password': 'password'})
+    assert resp.json['user']['email'] == 'vgavro@gmail.com'
+    assert client.get('/user/status').json['user'] == resp.json['user']
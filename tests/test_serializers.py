@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+import pytest
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+from flask_userflow.serializers import KeyedSerializer, CompactTokenSerializer
+
+
+def test_keyed_serializer_rotation():
+    old = KeyedSerializer([(1, 'first')], salt='salt')
+    token = old.dumps('data')
+    assert token.startswith('1.')
+
+    past, future = datetime.utcnow() - timedelta(days=1), datetime.utcnow() + timedelta(days=1)
+    new = KeyedSerializer([(1, 'first', future), (2, 'second')], salt='salt')
+    assert new.dumps('data').startswith('2.')
+    assert new.loads(token) == 'data'
+    assert new.loads(new.dumps('data'), max_age=10) == 'data'
+
+    retired = KeyedSerializer([(1, 'first', past), (2, 'second')], salt='salt')
+    with pytest.raises(BadSignature):
+        retired.loads(token)
+    with pytest.raises(BadSignature):
+        retired.loads('3.' + token[2:])
+    # key id is signed with token
+    with pytest.raises(BadSignature):
+        new.loads('2.' + token[2:])
+
+
+def test_keyed_serializer_legacy_tokens():
+    token = URLSafeTimedSerializer('secret', salt='salt').dumps({'id': 1})
+    serializer = KeyedSerializer([(0, 'secret'), (1, 'new')], salt='salt')
+    assert serializer.loads(token) == {'id': 1}
+    assert serializer.dumps('data').startswith('1.')
+    with pytest.raises(BadSignature):
+        KeyedSerializer([(1, 'new')], salt='salt').loads(token)
+
+
+def test_compact_token_serializer():
+    auth_id = 'c4ca4238a0b923820dcc509a6f75849b'
+    fallback = URLSafeTimedSerializer('first', salt='salt')
+    serializer = CompactTokenSerializer([(1, 'first')], salt='salt', fallback=fallback)
+    token = serializer.dumps(auth_id)
+    assert len(token) == 51 and '.' not in token
+    assert serializer.loads(token, max_age=10) == auth_id
+    assert serializer.loads(fallback.dumps(auth_id)) == auth_id
+
+    with pytest.raises(SignatureExpired):
+        serializer.loads(token, max_age=-1)
+    for invalid in (token[:-2] + 'AA', token[:20], 'not a token!',
+                    CompactTokenSerializer([(1, 'other')], salt='salt').dumps(auth_id),
+                    CompactTokenSerializer([(1, 'first')], salt='other').dumps(auth_id),
+                    CompactTokenSerializer([(2, 'first')], salt='salt').dumps(auth_id)):
+        with pytest.raises(BadSignature):
+            serializer.loads(invalid)
@@ -0,0 +1,23 @@
+from flask_userflow.throttle import MemoryThrottleStore
+
+
+def test_sliding_window():
+    store = MemoryThrottleStore()
+    assert store.hit('key', 10, now=100) == 1
+    assert store.hit('key', 10, now=105) == 2
+    # previous window weighted by remaining part of it
+    assert store.hit('key', 10, now=115) == 1 + 2 * 0.5
+    # previous windows are outdated
+    assert store.hit('key', 10, now=135) == 1
+
+
+def test_max_keys():
+    store = MemoryThrottleStore(max_keys=10)
+    for i in range(10):
+        store.hit(i, 10, now=100)
+    store.hit('fresh', 10, now=200)
+    assert len(store) == 1
+
+    for i in range(20):
+        store.hit(i, 10, now=200)
+    assert len(store) <= 10
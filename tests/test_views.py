@@ -1,3 +1,13 @@
+import time
+
+import pytest
+from flask import g, request
+from flask_principal import RoleNeed
+
+from flask_userflow import MemoryDatastore, signals
+from utils import MemoryUser, init_userflow
+
+
 def test_status(client):
     resp = client.get('/user/status')
     assert resp.status_code == 200
@@ -54,6 +64,22 @@ def test_timezones(client):
     resp = client.get('/user/timezones')
     assert resp.status_code == 200
     assert resp.json['timezones']
+    assert resp.headers['ETag']
+    assert resp.cache_control.max_age > 0
+
+
+def test_timezones_cache(client):
+    userflow = client.application.extensions['userflow']
+    resp = client.get('/user/timezones')
+    etag = resp.headers['ETag']
+    assert userflow.timezone_choices('en')['etag'] == etag.strip('"')
+
+    resp = client.get('/user/timezones', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert not resp.data
+    assert resp.headers['ETag'] == etag
+
+    assert userflow.get_timezone_choices('en') is userflow.get_timezone_choices('en')
 
 
 def test_login_success(client):
@@ -277,3 +303,423 @@ def test_password_change(client):
     resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
                                              'password': 'newpassword'})
     assert resp.status_code == 200
+
+
+def test_password_executor(create_client):
+    client = create_client(PASSWORD_EXECUTOR='thread', PASSWORD_EXECUTOR_WORKERS=1,
+                           PASSWORD_EXECUTOR_QUEUE_SIZE=0)
+    executor = client.application.userflow.password_executor
+    submitted = executor.stats()['submitted']
+
+    test_login_success(client)
+    stats = client.application.userflow.stats()['password_executor']
+    assert stats['submitted'] == submitted + 1
+    assert stats['pending'] == 0
+
+    # executor is full
+    executor._slots.acquire()
+    try:
+        resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                                 'password': 'password'})
+    finally:
+        executor._slots.release()
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After']
+    assert executor.stats()['rejected'] == 1
+
+
+def test_password_calibrate(create_client):
+    client = create_client(PASSWORD_CALIBRATE=True, PASSWORD_CALIBRATE_TIME=0.001,
+                           PASSWORD_CALIBRATE_MIN_ROUNDS=4, PASSWORD_CALIBRATE_MAX_ROUNDS=6)
+    assert 4 <= client.application.userflow.config['PASSWORD_ROUNDS'] <= 6
+
+
+def test_password_rehash_on_login(client):
+    userflow = client.application.extensions['userflow']
+    results = []
+    rehash_password = userflow.rehash_password
+    userflow.rehash_password = lambda *args: results.append(rehash_password(*args))
+
+    test_login_success(client)
+    assert not results
+
+    userflow.config['PASSWORD_ROUNDS'] = 5
+    test_login_success(client)
+    assert len(results) == 1
+    results[0].get()
+
+    with client.application.app_context():
+        user = userflow.datastore.find_user(email='vgavro@gmail.com')
+        assert user.password.startswith('$2b$05$')
+        assert not user.password_needs_rehash()
+        assert user.verify_password('password')
+
+
+def test_password_rehash_busy(client):
+    userflow = client.application.extensions['userflow']
+    userflow.config['PASSWORD_ROUNDS'] = 5
+    executor = userflow.rehash_executor
+    slots = executor.workers + executor.queue_size
+    for _ in range(slots):
+        executor._slots.acquire()
+    try:
+        # login is not affected, rehash is skipped until next login
+        test_login_success(client)
+    finally:
+        for _ in range(slots):
+            executor._slots.release()
+    assert executor.stats()['rejected'] == 1
+    with client.application.app_context():
+        assert userflow.datastore.find_user(email='vgavro@gmail.com').password_needs_rehash()
+
+
+def test_password_scheme_migration(client):
+    userflow = client.application.extensions['userflow']
+    userflow.password_hashers.default = userflow.password_hashers.get('pbkdf2_sha256')
+    userflow.config['PASSWORD_PBKDF2_ROUNDS'] = 1000
+    results = []
+    rehash_password = userflow.rehash_password
+    userflow.rehash_password = lambda *args: results.append(rehash_password(*args))
+
+    test_login_success(client)
+    results[0].get()
+
+    with client.application.app_context():
+        user = userflow.datastore.find_user(email='vgavro@gmail.com')
+        assert user.password.startswith('$pbkdf2-sha256$1000$')
+        assert user.verify_password('password')
+
+
+def test_login_throttle(create_client):
+    client = create_client(LOGIN_THROTTLE_EMAIL=(2, 60))
+    userflow = client.application.extensions['userflow']
+    datastore = userflow.datastore
+    find_user = datastore.find_user
+    calls = []
+    datastore.find_user = lambda **kwargs: calls.append(kwargs) or find_user(**kwargs)
+
+    for _ in range(2):
+        resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                                 'password': 'badpassword'})
+        assert resp.status_code == 422
+
+    calls[:] = []
+    resp = client.post('/user/status', json={'email': 'VGavro@gmail.com ',
+                                             'password': 'password'})
+    assert resp.status_code == 429
+    assert resp.headers['Retry-After'] == '60'
+    assert not calls
+    assert userflow.stats()['throttle']['rejected'] == 1
+
+    # other email is not affected
+    resp = client.post('/user/status', json={'email': 'matt@lp.com', 'password': 'password'})
+    assert resp.status_code == 422
+
+
+def test_restore_start_throttle(create_client):
+    client = create_client(RESTORE_START_THROTTLE_ADDR=(1, 60))
+    resp = client.post('/user/restore', json={'email': 'vgavro@gmail.com'})
+    assert resp.status_code == 200
+    resp = client.post('/user/restore', json={'email': 'matt@lp.com'})
+    assert resp.status_code == 429
+
+
+def test_guess_timezone_by_offset(sqlalchemy_app):
+    request_utils = sqlalchemy_app.userflow.request_utils
+    index = request_utils.get_tz_offset_index()
+    assert request_utils.get_tz_offset_index() is index
+    assert 'Asia/Kolkata' in index[330]
+
+    with sqlalchemy_app.test_request_context():
+        assert request_utils.guess_timezone(browser_tz_offset=330) == 'Asia/Kolkata'
+        assert request_utils.guess_timezone(browser_tz_offset=7) == 'UTC'
+
+
+def test_user_cache(create_client):
+    client = create_client(USER_CACHE=True)
+    userflow = client.application.extensions['userflow']
+    cache = userflow.user_cache
+
+    test_login_success(client)
+    hits = cache.hits
+    for _ in range(2):
+        resp = client.get('/user/status')
+        assert resp.json['user']['email'] == 'vgavro@gmail.com'
+    assert cache.hits == hits + 2
+    assert userflow.stats()['user_cache']['hits'] == cache.hits
+    assert not any('password' in data for _, data in cache._data.values())
+
+    # password change invalidates cache, but session is still valid
+    resp = client.post('/user/password_change', json={'old_password': 'password',
+                                                      'password': 'newpassword',
+                                                      'confirm_password': 'newpassword'})
+    assert resp.status_code == 200
+    misses = cache.misses
+    resp = client.get('/user/status')
+    assert resp.json['user']['email'] == 'vgavro@gmail.com'
+    assert cache.misses == misses + 1
+
+    # updates by datastore are invalidating cache too
+    with client.application.app_context():
+        user = userflow.datastore.find_user(email='vgavro@gmail.com')
+        assert cache.get(user.auth_id) is not None
+        user.is_active = False
+        userflow.datastore.commit()
+        assert cache.get(user.auth_id) is None
+
+
+def test_roles_without_role_model(app):
+    class User(MemoryUser):
+        roles = ('editor',)
+
+        def add_role(self, name):
+            pass
+
+    client = init_userflow(app, MemoryDatastore(User)).test_client()
+    test_login_success(client)
+    with client:
+        client.get('/user/status')
+        assert RoleNeed('editor') in g.identity.provides
+
+
+@pytest.mark.parametrize('roles', [('editor',), None])
+def test_auth_token_stateless_without_role_model(app, roles):
+    class User(MemoryUser):
+        def add_role(self, name):
+            pass
+    if roles:
+        User.roles = roles
+    app.config['USERFLOW_AUTH_TOKEN_FORMAT'] = 'stateless'
+    client = init_userflow(app, MemoryDatastore(User)).test_client()
+    resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                             'password': 'password'})
+    headers = {'Authentication-Token': resp.json['auth_token']}
+
+    client = app.test_client()
+    with client:
+        resp = client.get('/user/status', headers=headers)
+        assert resp.json['user']['email'] == 'vgavro@gmail.com'
+        assert (RoleNeed('editor') in g.identity.provides) == bool(roles)
+
+
+def test_roles(create_client):
+    client = create_client(ROLES_CACHE=True)
+    userflow = client.application.extensions['userflow']
+    datastore = userflow.datastore
+    calls = []
+    find_roles_for_users = datastore.find_roles_for_users
+    datastore.find_roles_for_users = lambda ids: calls.append(ids) or find_roles_for_users(ids)
+
+    test_login_success(client)
+    with client:
+        client.get('/user/status')
+        assert RoleNeed('admin') in g.identity.provides
+        assert g.identity.user.has_role('admin')
+        assert not g.identity.user.has_role('admin', 'other')
+    # loaded once, next requests are using cache
+    assert len(calls) == 1
+
+    with client.application.test_request_context():
+        user = datastore.find_user(email='vgavro@gmail.com')
+        user.add_role('other')
+        assert user.has_role('admin', 'other')
+        user.delete_role('admin')
+        assert user.roles == ['other']
+        assert userflow.load_roles([user]) == {user.id: ['other']}
+
+
+def test_ua_cache(create_client):
+    ua = 'Mozilla/5.0 (X11; Linux x86_64; rv:63.0) Gecko/20100101 Firefox/63.0'
+    client = create_client(UA_PARSER_WARMUP=True, UA_MAX_LENGTH=len(ua))
+    userflow = client.application.extensions['userflow']
+
+    for i in range(3):
+        with client.application.test_request_context(headers={'User-Agent': ua + str(i)}):
+            ua_info = userflow.request_utils.get_ua_info()
+            assert ua_info['user_agent']['family'] == 'Firefox'
+            assert ua_info['string'] == ua
+    stats = userflow.stats()['ua_cache']
+    assert stats['hits'] == 2
+    assert stats['size'] == 1
+
+
+def test_track_login_buffer(create_client):
+    client = create_client(TRACK_LOGIN_BUFFER=True, TRACK_LOGIN_BUFFER_SIZE=3,
+                           TRACK_LOGIN_BUFFER_INTERVAL=60)
+    userflow = client.application.userflow
+
+    for _ in range(2):
+        resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                                'password': 'password'})
+        assert resp.status_code == 200
+    with client.application.app_context():
+        assert not list(userflow.datastore.find_track_logins())
+    assert userflow.stats()['track_login_buffer']['buffered'] == 2
+
+    # size threshold wakes up flusher thread
+    resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                            'password': 'password'})
+    for _ in range(40):
+        if not len(userflow.track_login_buffer):
+            break
+        time.sleep(0.05)
+    assert userflow.flush() == 0
+
+    with client.application.app_context():
+        rows = list(userflow.datastore.find_track_logins())
+        assert len(rows) == 3
+        assert rows[0].remote_addr
+    stats = userflow.stats()['track_login_buffer']
+    assert stats['flushed'] == 3
+    assert stats['flushes'] == 1
+    assert stats['failed'] == 0
+
+
+def test_auth_token_header(client):
+    resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                             'password': 'password'})
+    token = resp.json['auth_token']
+
+    # new client without session cookie
+    client = client.application.test_client()
+    assert not client.get('/user/status').json['user']
+    resp = client.get('/user/status', headers={'Authentication-Token': token})
+    assert resp.json['user']['email'] == 'vgavro@gmail.com'
+    resp = client.get('/user/status', headers={'Authentication-Token': token[:-1]})
+    assert not resp.json['user']
+
+
+def test_auth_token_stateless(create_client):
+    client = create_client(AUTH_TOKEN_FORMAT='stateless')
+    userflow = client.application.userflow
+    resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                             'password': 'password'})
+    headers = {'Authentication-Token': resp.json['auth_token']}
+    client = client.application.test_client()
+
+    calls = []
+
+    def on_called(datastore, method, duration):
+        calls.append(method)
+    signals.datastore_called.connect(on_called)
+    try:
+        resp = client.get('/user/status', headers=headers)
+        assert resp.json['user']['email'] == 'vgavro@gmail.com'
+        assert resp.json['user']['name'] == 'Victor Gavro'
+        assert not calls
+    finally:
+        signals.datastore_called.disconnect(on_called)
+
+    with client.application.test_request_context(headers=headers):
+        assert userflow._request_loader(request).roles == ['admin']
+
+    with client.application.app_context():
+        user = userflow.datastore.find_user(email='vgavro@gmail.com')
+        user.generate_auth_id()
+        userflow.datastore.commit()
+
+    # revocation is honoured after staleness window
+    assert client.get('/user/status', headers=headers).json['user']
+    userflow.config['AUTH_TOKEN_MAX_STALENESS'] = -1
+    assert not client.get('/user/status', headers=headers).json['user']
+
+    # stale token of valid user is checked and refreshed
+    with client.application.app_context():
+        user = userflow.datastore.find_user(email='vgavro@gmail.com')
+        headers = {'Authentication-Token': user.get_auth_token()}
+    resp = client.get('/user/status', headers=headers)
+    assert resp.json['user']
+    assert resp.headers['Authentication-Token']
+
+
+def test_revoke_auth_token(create_client):
+    client = create_client(AUTH_TOKEN_REVOCATION=True)
+    userflow = client.application.userflow
+    resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                             'password': 'password'})
+    token = resp.json['auth_token']
+    headers = {'Authentication-Token': token}
+    other_client = client.application.test_client()
+    assert other_client.get('/user/status', headers=headers).json['user']
+
+    assert userflow.revoke_auth_token(token)
+    assert not userflow.revoke_auth_token(token[:-1])
+    # token and session it was issued for are revoked
+    assert not other_client.get('/user/status', headers=headers).json['user']
+    assert not client.get('/user/status').json['user']
+    assert userflow.stats()['revocations']['revoked'] == 2
+
+
+def test_secret_keys(create_client):
+    client = create_client(SECRET_KEYS=[(1, 'first'), (2, 'second')])
+    resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                             'password': 'password'})
+    token = resp.json['auth_token']
+    assert token.startswith('2.')
+    client = client.application.test_client()
+    resp = client.get('/user/status', headers={'Authentication-Token': token})
+    assert resp.json['user']
+
+
+def test_auth_token_compact(create_client):
+    client = create_client(AUTH_TOKEN_FORMAT='compact')
+    resp = client.post('/user/status', json={'email': 'vgavro@gmail.com',
+                                             'password': 'password'})
+    token = resp.json['auth_token']
+    assert len(token) == 51
+    # session login is not affected
+    assert client.get('/user/status').json['user']
+    client = client.application.test_client()
+    resp = client.get('/user/status', headers={'Authentication-Token': token})
+    assert resp.json['user']['email'] == 'vgavro@gmail.com'
+
+
+def test_status_etag(create_client):
+    client = create_client(STATUS_CACHE=True)
+    userflow = client.application.userflow
+
+    resp = client.get('/user/status')
+    etag = resp.headers['ETag']
+    assert client.get('/user/status', headers={'If-None-Match': etag}).status_code == 304
+
+    client.post('/user/status', json={'email': 'vgavro@gmail.com', 'password': 'password'})
+    resp = client.get('/user/status', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    resp = client.get('/user/status', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert not resp.data
+    # user is serialized once for login response
+    assert userflow.stats()['status_cache']['misses'] == 1
+
+    resp = client.post('/user/set_i18n', json={'locale': 'ru'})
+    resp = client.get('/user/status', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+
+    # profile update invalidates cache by datastore signal
+    with client.application.app_context():
+        user = userflow.datastore.find_user(email='vgavro@gmail.com')
+        user.name = 'Changed'
+        userflow.datastore.commit()
+    resp = client.get('/user/status', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.json['user']['name'] == 'Changed'
+
+
+def test_status_etag_serializes_once(create_client, monkeypatch):
+    client = create_client()
+    schema = client.application.userflow.schemas['user_schema']
+    calls = []
+    dump = schema.dump
+    monkeypatch.setattr(schema, 'dump', lambda user: calls.append(user) or dump(user))
+    client.post('/user/status', json={'email': 'vgavro@gmail.com', 'password': 'password'})
+
+    del calls[:]
+    resp = client.get('/user/status')
+    assert resp.status_code == 200
+    assert len(calls) == 1
+    # without status cache user is serialized to check etag
+    resp = client.get('/user/status', headers={'If-None-Match': resp.headers['ETag']})
+    assert resp.status_code == 304
+    assert len(calls) == 2
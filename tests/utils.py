@@ -2,6 +2,8 @@ from flask import json, Response as BaseResponse
 from flask.testing import FlaskClient
 from werkzeug.utils import cached_property
 
+from flask_userflow import Userflow, UserMixin
+
 
 class Response(BaseResponse):
     @cached_property
@@ -28,4 +30,26 @@ def populate_datastore(userflow):
         user.set_password(u[2])
         user.generate_auth_id()
         userflow.datastore.put(user)
-    userflow.datastore.commit()
+        userflow.datastore.commit()
+        for role in u[3]:
+            user.add_role(role)
+
+
+class MemoryModel(object):
+    """Model for MemoryDatastore"""
+    id = None
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class MemoryUser(MemoryModel, UserMixin):
+    # shadow UserMixin properties with fields
+    email = name = auth_id = password = is_active = locale = timezone = None
+
+
+def init_userflow(app, datastore, **kwargs):
+    app.userflow = Userflow(app, datastore=datastore, **kwargs)
+    with app.app_context():
+        populate_datastore(app.userflow)
+    return app